@@ -0,0 +1,263 @@
+"""
+Cache of AI lawyer answers, checked before a question is queued for the model.
+
+Tier one is an exact match on the normalized question: an in-memory LRU with a TTL, backed by the
+answer_cache collection in Mongo so answers survive restarts and are shared between workers. Tier
+two embeds the question and returns the answer of the most similar cached question, when the
+cosine similarity reaches `threshold`.
+
+Every entry records the version of documents_collection it was answered from (chunk count plus
+the newest (ingested_at, _id)); once the documents change, older entries are dropped.
+"""
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from pymongo import DESCENDING
+from pymongo.errors import PyMongoError
+
+from cooperative import offload
+
+
+Lookup = namedtuple('Lookup', ['answer', 'tier', 'key', 'question', 'embedding'])
+
+
+def normalize_question(text):
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def corpus_version(collection):
+    latest = collection.find_one({}, {'ingested_at': 1}, sort=[('ingested_at', DESCENDING), ('_id', DESCENDING)])
+    if latest is None:
+        return 'empty'
+    ingested_at = latest.get('ingested_at')
+    return f"{collection.estimated_document_count()}:{ingested_at.isoformat() if ingested_at else ''}:{latest['_id']}"
+
+
+class AnswerCache:
+    def __init__(self, collection, documents, embedder=None, capacity=1000, semantic_capacity=50000,
+                 ttl=7 * 24 * 3600, threshold=0.92, check_interval=30.0):
+        """
+        :param collection: Mongo collection the entries are persisted in.
+        :param documents: documents_collection, watched for changes.
+        :param embedder: Callable returning an object with embed(texts); None disables the semantic tier.
+        :param threshold: Lowest cosine similarity at which a cached answer is reused for a new question.
+        """
+        self.collection = collection
+        self.documents = documents
+        self.embedder = embedder
+        self.capacity = capacity
+        self.semantic_capacity = semantic_capacity
+        self.ttl = ttl
+        self.threshold = threshold
+        self.check_interval = check_interval
+
+        self._entries = OrderedDict()
+        # Semantic tier: question embeddings in the first `_count` rows of `_vectors`, which grows by
+        # doubling up to semantic_capacity and is then reused as a ring, oldest row first.
+        self._vectors = None
+        self._count = 0
+        self._oldest = 0
+        self._keys = []
+        self._rows = {}
+        self._embedder_failed = False
+        self._lock = threading.RLock()
+        self._version = None
+        self._checked_at = None
+        self._loaded = False
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_version(self):
+        """Drops every entry answered from an older version of documents_collection."""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        version = corpus_version(self.documents)
+        with self._lock:
+            if version == self._version:
+                return
+            if self._version is not None:
+                self.invalidations += 1
+            self._version = version
+            self._entries.clear()
+            self._clear_semantic()
+            self._loaded = False
+        self.collection.delete_many({'corpus_version': {'$ne': version}})
+
+    def _ensure_indexes(self):
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+        self.collection.create_index('corpus_version')
+
+    def _load(self):
+        """Reads the stored embeddings of the current version for the semantic tier."""
+        if self._loaded:
+            return
+        self._ensure_indexes()
+        entries = []
+        if self.embedder is not None:
+            query = {'corpus_version': self._version, 'embedding': {'$ne': None},
+                     'expires_at': {'$gt': datetime.now(timezone.utc)}}
+            entries = list(self.collection.find(query, {'embedding': 1}))
+        with self._lock:
+            self._clear_semantic()
+            for entry in entries:
+                self._add_vector(entry['_id'], entry['embedding'])
+            self._loaded = True
+
+    def _clear_semantic(self):
+        self._vectors = None
+        self._count = self._oldest = 0
+        self._keys, self._rows = [], {}
+
+    def _add_vector(self, key, vector):
+        """Adds a question's embedding to the semantic tier; call with the lock held."""
+        vector = np.asarray(vector, dtype=np.float32)
+        row = self._rows.get(key)
+        if row is None:
+            if self._vectors is None:
+                self._vectors = np.empty((min(1024, self.semantic_capacity), len(vector)), dtype=np.float32)
+            if self._count < self.semantic_capacity:
+                if self._count == len(self._vectors):
+                    grown = np.empty((min(2 * self._count, self.semantic_capacity), self._vectors.shape[1]),
+                                     dtype=np.float32)
+                    grown[:self._count] = self._vectors
+                    self._vectors = grown
+                row = self._count
+                self._count += 1
+                self._keys.append(key)
+            else:
+                # The oldest questions leave the semantic tier first; Mongo's TTL index expires them too.
+                row = self._oldest
+                self._oldest = (self._oldest + 1) % self.semantic_capacity
+                del self._rows[self._keys[row]]
+                self._keys[row] = key
+            self._rows[key] = row
+        self._vectors[row] = vector
+
+    def _embed(self, question):
+        if self.embedder is None or self._embedder_failed:
+            return None
+        try:
+            embedder = self.embedder()
+        except Exception:
+            # Loading is not retried on every miss; without an embedder the cache serves exact matches.
+            self._embedder_failed = True
+            return None
+        try:
+            return offload(embedder.embed, [question])[0]
+        except Exception:
+            return None
+
+    def _remember(self, key, answer, expires_at):
+        self._entries[key] = (answer, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def lookup(self, question):
+        """
+        :return: Lookup with the cached answer, or with answer None and what store() needs on a miss.
+        """
+        normalized = normalize_question(question)
+        key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        try:
+            self._check_version()
+            self._load()
+        except PyMongoError:
+            pass
+        now = time.time()
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[1] > now:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return Lookup(cached[0], 'exact', key, normalized, None)
+        try:
+            entry = self.collection.find_one({'_id': key, 'corpus_version': self._version})
+        except PyMongoError:
+            entry = None
+        if entry is not None and entry['expires_at'].replace(tzinfo=timezone.utc).timestamp() > now:
+            with self._lock:
+                self._remember(key, entry['answer'], entry['expires_at'].replace(tzinfo=timezone.utc).timestamp())
+                self.exact_hits += 1
+            return Lookup(entry['answer'], 'exact', key, normalized, None)
+
+        embedding = self._embed(normalized)
+        if embedding is not None:
+            best_key = None
+            with self._lock:
+                # Under the lock: store() may overwrite the oldest row in place.
+                if self._count:
+                    scores = self._vectors[:self._count] @ embedding
+                    best = int(scores.argmax())
+                    if scores[best] >= self.threshold:
+                        best_key = self._keys[best]
+            if best_key is not None:
+                answer = self._answer(best_key)
+                if answer is not None:
+                    with self._lock:
+                        self.semantic_hits += 1
+                    return Lookup(answer, 'semantic', key, normalized, embedding)
+
+        with self._lock:
+            self.misses += 1
+        return Lookup(None, None, key, normalized, embedding)
+
+    def _answer(self, key):
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[1] > time.time():
+                return cached[0]
+        try:
+            entry = self.collection.find_one({'_id': key, 'corpus_version': self._version}, {'answer': 1})
+        except PyMongoError:
+            return None
+        return entry['answer'] if entry else None
+
+    def store(self, lookup, answer):
+        """Caches the model's answer to the question of a missed lookup."""
+        if not answer.strip():
+            return
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        with self._lock:
+            self._remember(lookup.key, answer, expires_at.timestamp())
+            if lookup.embedding is not None:
+                self._add_vector(lookup.key, lookup.embedding)
+            version = self._version
+        try:
+            self.collection.replace_one({'_id': lookup.key}, {
+                'question': lookup.question,
+                'answer': answer,
+                'embedding': lookup.embedding.tolist() if lookup.embedding is not None else None,
+                'corpus_version': version,
+                'expires_at': expires_at,
+            }, upsert=True)
+        except PyMongoError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'semantic_entries': self._count,
+                'semantic_available': self.embedder is not None and not self._embedder_failed,
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,323 @@
+"""
+Prompts for the legal assistant that fit a fixed token budget however long the conversation gets.
+
+Every chat room has a conversation: its recent turns with their token counts, and a summary of the
+turns that no longer fit. A turn is tokenized once, when it is added, and the counts are kept, so
+adding a turn or building a prompt costs what the new text costs, not the whole conversation.
+Once the recent turns outgrow the budget, the oldest ones are handed to a background thread that
+folds them into the summary; building a prompt never waits for it.
+
+A prompt is the instructions, the question, then, while the budget lasts: the summary, the
+top-ranked passages from documents_collection, and as many recent turns as fit, newest first.
+"""
+import math
+import os
+import queue
+import re
+import threading
+from collections import OrderedDict, deque, namedtuple
+
+
+INSTRUCTIONS = ('You are a careful legal assistant. Answer the question clearly and say when a lawyer '
+                'should be consulted.')
+# The name the assistant's answers go under in a conversation.
+ASSISTANT = 'AI lawyer'
+
+Context = namedtuple('Context', ['prompt', 'prompt_tokens', 'full_tokens', 'turns', 'passages', 'summary_tokens'])
+Turn = namedtuple('Turn', ['text', 'tokens'])
+
+
+class ApproximateTokenizer:
+    """
+    Stands in for the model's tokenizer while it loads or when there is none: words and punctuation
+    marks, times `margin`, since subword tokenizers split many words into several tokens.
+    """
+
+    TOKEN_RE = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+    def __init__(self, margin=1.5):
+        self.margin = margin
+
+    def count(self, text):
+        return math.ceil(len(self.TOKEN_RE.findall(text)) * self.margin)
+
+
+def first_sentences(turns, max_words=40):
+    """Default summarizer: one line per folded turn, with the first sentence of what was said."""
+    lines = []
+    for turn in turns:
+        sentence = re.split(r'(?<=[.!?])\s', turn.text, maxsplit=1)[0]
+        words = sentence.split()
+        lines.append(' '.join(words[:max_words]) + (' ...' if len(words) > max_words else ''))
+    return lines
+
+
+class Conversation:
+    def __init__(self):
+        self.turns = deque()
+        self.turn_tokens = 0
+        self.summary = deque()
+        self.summary_tokens = 0
+        self.folding = []
+        # Tokens of every turn since the conversation started, i.e. of a prompt with the whole history.
+        self.history_tokens = 0
+
+
+class ContextBuilder:
+    def __init__(self, tokenizer=None, budget=768, summary_budget=128, passage_share=0.5, summarize=first_sentences,
+                 history=None, prefill_rate=None, max_conversations=1000):
+        """
+        :param tokenizer: Callable returning an object with encode(text, add_special_tokens=False),
+            normally the generator's tokenizer, loaded by load_tokenizer(). Until it is loaded, or
+            if it fails to load, counts come from ApproximateTokenizer.
+        :param budget: Tokens of the whole prompt, leaving the rest of the model's context for the answer.
+        :param summary_budget: Tokens the summary of older turns may take; its oldest lines go first.
+        :param passage_share: Part of the budget left after the question that passages may use.
+        :param summarize: Turns a list of folded Turns into summary lines; runs on the background thread.
+        :param history: Callable returning a room's stored chat messages, to seed a new conversation.
+        :param prefill_rate: Callable returning the generator's seconds per prompt token, or None if unknown.
+        """
+        self.tokenizer = tokenizer
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.passage_share = passage_share
+        self.summarize = summarize
+        self.history = history
+        self.prefill_rate = prefill_rate
+        self.max_conversations = max_conversations
+
+        self._tokenizer = None
+        self._approximate = ApproximateTokenizer()
+        self._loading = False
+        self._conversations = OrderedDict()
+        # Rooms whose stored history is being read, with the event set once it is loaded.
+        self._loads = {}
+        self._passage_tokens = OrderedDict()
+        self._lock = threading.RLock()
+        self._folds = queue.Queue()
+        self._pid = None
+
+        self.prompts = 0
+        self.prompt_tokens = 0
+        self.max_prompt_tokens = 0
+        self.full_tokens = 0
+        self.seconds_saved = 0.0
+        self.summaries = 0
+        self.turns_folded = 0
+
+    @classmethod
+    def from_app(cls, app, tokenizer=None, history=None, prefill_rate=None):
+        config = app.config
+        return cls(tokenizer, budget=config.get('CONTEXT_TOKEN_BUDGET', 768),
+                   summary_budget=config.get('CONTEXT_SUMMARY_TOKENS', 128), history=history,
+                   prefill_rate=prefill_rate)
+
+    def load_tokenizer(self):
+        """
+        Loads the tokenizer in a background thread, so neither startup nor a socket handler waits
+        for transformers to import.
+        """
+        with self._lock:
+            if self.tokenizer is None or self._loading:
+                return
+            self._loading = True
+        threading.Thread(target=self._load_tokenizer, name='context-tokenizer', daemon=True).start()
+
+    def _load_tokenizer(self):
+        try:
+            self._tokenizer = self.tokenizer()
+        except Exception:
+            pass
+
+    def count(self, text):
+        tokenizer = self._tokenizer
+        if tokenizer is None:
+            return self._approximate.count(text)
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    def _ensure_folder(self):
+        # The summarizing thread does not survive fork(); a forked web worker starts its own.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='context-summarizer', daemon=True).start()
+
+    def _conversation(self, room):
+        with self._lock:
+            conversation = self._conversations.get(room)
+            if conversation is not None:
+                self._conversations.move_to_end(room)
+                return conversation
+            loading = self._loads.get(room)
+            if loading is None:
+                loading = self._loads[room] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # Another thread is reading the room's history; its conversation is the one to use.
+            loading.wait()
+            return self._conversation(room)
+        try:
+            # The stored history is replayed into a conversation no other thread can see yet, so
+            # turns added meanwhile cannot land before it.
+            loaded = Conversation()
+            for message in self.history(room) if self.history else []:
+                self._add(loaded, None, message['name'], message['message'])
+            with self._lock:
+                self._conversations[room] = loaded
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+                if loaded.folding:
+                    self._ensure_folder()
+                    self._folds.put(room)
+            return loaded
+        finally:
+            with self._lock:
+                del self._loads[room]
+            loading.set()
+
+    def add_turn(self, room, name, message):
+        """
+        Adds what `name` said to the room's conversation; older turns past the budget are queued for summarizing.
+        A room without a conversation yet is skipped: its first build() reads the stored history.
+        """
+        with self._lock:
+            conversation = self._conversations.get(room)
+        if conversation is not None:
+            self._add(conversation, room, name, message)
+
+    def _add(self, conversation, room, name, message):
+        """:param room: None while the conversation is being loaded; its folded turns are queued once it is published."""
+        text = f'{name}: {message}'
+        turn = Turn(text, self.count(text) + 1)
+        with self._lock:
+            conversation.turns.append(turn)
+            conversation.turn_tokens += turn.tokens
+            conversation.history_tokens += turn.tokens
+            folded = []
+            # No prompt can hold more turns than the budget, so only that much is kept verbatim.
+            while conversation.turn_tokens > self.budget and len(conversation.turns) > 1:
+                old = conversation.turns.popleft()
+                conversation.turn_tokens -= old.tokens
+                folded.append(old)
+            if folded:
+                if not conversation.folding and room is not None:
+                    self._ensure_folder()
+                    self._folds.put(room)
+                conversation.folding.extend(folded)
+
+    def has_history(self, room):
+        """Whether the room's conversation has anything a prompt would include besides the question."""
+        conversation = self._conversation(room)
+        with self._lock:
+            return bool(conversation.turns or conversation.summary or conversation.folding)
+
+    def close_room(self, room):
+        with self._lock:
+            self._conversations.pop(room, None)
+
+    def _run(self):
+        while True:
+            room = self._folds.get()
+            with self._lock:
+                conversation = self._conversations.get(room)
+                turns = list(conversation.folding) if conversation else []
+            if not turns:
+                continue
+            try:
+                lines = [(line, self.count(line) + 1) for line in self.summarize(turns) if line]
+            except Exception:
+                lines = []
+            with self._lock:
+                # Turns added to `folding` meanwhile stay for the next round.
+                del conversation.folding[:len(turns)]
+                if conversation.folding:
+                    self._folds.put(room)
+                conversation.summary.extend(lines)
+                conversation.summary_tokens += sum(tokens for _, tokens in lines)
+                while conversation.summary_tokens > self.summary_budget and conversation.summary:
+                    conversation.summary_tokens -= conversation.summary.popleft()[1]
+                self.summaries += 1
+                self.turns_folded += len(turns)
+
+    def _passage_count(self, key, text):
+        with self._lock:
+            tokens = self._passage_tokens.get(key)
+            if tokens is not None:
+                self._passage_tokens.move_to_end(key)
+                return tokens
+        tokens = self.count(text) + 4
+        with self._lock:
+            self._passage_tokens[key] = tokens
+            while len(self._passage_tokens) > 10000:
+                self._passage_tokens.popitem(last=False)
+        return tokens
+
+    def build(self, room, question, passages=()):
+        """
+        :param passages: (key, text) pairs, best first; token counts are cached by key.
+        :return: A Context.
+        """
+        conversation = self._conversation(room)
+        question_tokens = self.count(question) + self.count(INSTRUCTIONS) + 8
+        remaining = self.budget - question_tokens
+
+        with self._lock:
+            summary = [line for line, _ in conversation.summary] if conversation.summary_tokens <= remaining else []
+            summary_tokens = conversation.summary_tokens if summary else 0
+            turns = list(conversation.turns)
+            history_tokens = conversation.history_tokens
+        remaining -= summary_tokens
+
+        chosen, passage_budget, all_passage_tokens = [], int(remaining * self.passage_share), 0
+        for key, text in passages:
+            tokens = self._passage_count(key, text)
+            all_passage_tokens += tokens
+            if tokens <= passage_budget:
+                chosen.append(text)
+                passage_budget -= tokens
+                remaining -= tokens
+
+        recent = []
+        for turn in reversed(turns):
+            if turn.tokens > remaining:
+                break
+            recent.append(turn.text)
+            remaining -= turn.tokens
+        recent.reverse()
+
+        parts = [INSTRUCTIONS]
+        if chosen:
+            parts.append('Relevant law:\n' + '\n'.join(f'[{n}] {text}' for n, text in enumerate(chosen, 1)))
+        if summary:
+            parts.append('Earlier in this conversation:\n' + '\n'.join(summary))
+        if recent:
+            parts.append('Recent conversation:\n' + '\n'.join(recent))
+        parts.append(f'Question: {question}\nAnswer:')
+
+        prompt_tokens = self.budget - remaining
+        full_tokens = question_tokens + history_tokens + all_passage_tokens
+        rate = self.prefill_rate() if self.prefill_rate else None
+        with self._lock:
+            self.prompts += 1
+            self.prompt_tokens += prompt_tokens
+            self.max_prompt_tokens = max(self.max_prompt_tokens, prompt_tokens)
+            self.full_tokens += full_tokens
+            if rate:
+                self.seconds_saved += max(full_tokens - prompt_tokens, 0) * rate
+        return Context('\n\n'.join(parts), prompt_tokens, full_tokens, len(recent), len(chosen), summary_tokens)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._conversations),
+                'prompts': self.prompts,
+                'avg_prompt_tokens': round(self.prompt_tokens / self.prompts, 1) if self.prompts else 0.0,
+                'max_prompt_tokens': self.max_prompt_tokens,
+                'avg_full_history_tokens': round(self.full_tokens / self.prompts, 1) if self.prompts else 0.0,
+                'tokens_saved': self.full_tokens - self.prompt_tokens,
+                'estimated_prefill_ms_saved': round(self.seconds_saved * 1000, 1),
+                'summaries': self.summaries,
+                'turns_folded': self.turns_folded,
+                'pending_folds': self._folds.qsize(),
+            }
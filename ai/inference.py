@@ -0,0 +1,243 @@
+"""
+Micro-batched text generation for the legal assistant.
+
+Questions from all chat rooms go into one queue. A dedicated worker thread takes up to
+`max_batch_size` of them, waiting at most `max_wait` seconds for the batch to fill, and decodes
+the whole batch step by step on CPU. Every new piece of text is handed to the request's
+`on_token` callback as soon as it is decoded, so answers stream while the batch is still running.
+Under gevent or eventlet the worker is a green thread, and each decoding step runs in a native
+thread (cooperative.iterate) so sockets keep being served during a batch.
+"""
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+
+from cooperative import iterate
+
+
+class GenerationRequest:
+    _ids = itertools.count(1)
+
+    def __init__(self, prompt, on_token, on_done, max_new_tokens):
+        self.id = next(self._ids)
+        self.prompt = prompt
+        self.on_token = on_token
+        self.on_done = on_done
+        self.max_new_tokens = max_new_tokens
+        self.submitted_at = time.monotonic()
+        self.first_token_at = None
+        self.done = False
+
+
+class QueueFull(Exception):
+    pass
+
+
+class TransformersGenerator:
+    """
+    Greedy batched decoding with a causal LM from transformers. Prompts are left-padded so every
+    sequence of the batch produces its next token at the same position, and the KV cache is reused
+    between steps. Prompts longer than max_input_tokens lose their beginning, never the question
+    at their end.
+    """
+
+    def __init__(self, model_name, max_input_tokens=1024):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side='left',
+                                                       truncation_side='left')
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model_name)
+        self.model.eval()
+        self.max_input_tokens = max_input_tokens
+        self.prefill_tokens = 0
+        self.prefill_seconds = 0.0
+
+    def prefill_rate(self):
+        """Seconds the first forward pass has taken per prompt token so far, or None before any."""
+        return self.prefill_seconds / self.prefill_tokens if self.prefill_tokens else None
+
+    def generate(self, prompts, max_new_tokens):
+        """Yields (sequence index, text piece) as tokens are decoded; (index, None) once a sequence ends."""
+        torch = self.torch
+        encoded = self.tokenizer(prompts, return_tensors='pt', padding=True, truncation=True,
+                                 max_length=self.max_input_tokens)
+        attention_mask = encoded['attention_mask']
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        inputs = encoded['input_ids']
+        past = None
+        finished = [False] * len(prompts)
+        tokens = [[] for _ in prompts]
+        texts = [''] * len(prompts)
+        eos = self.tokenizer.eos_token_id
+
+        with torch.inference_mode():
+            for step in range(max(max_new_tokens)):
+                started = time.perf_counter()
+                output = self.model(input_ids=inputs, attention_mask=attention_mask, position_ids=position_ids,
+                                    past_key_values=past, use_cache=True)
+                if step == 0:
+                    self.prefill_tokens += int(attention_mask.sum())
+                    self.prefill_seconds += time.perf_counter() - started
+                past = output.past_key_values
+                next_tokens = output.logits[:, -1, :].argmax(dim=-1)
+                for i, token in enumerate(next_tokens.tolist()):
+                    if finished[i]:
+                        continue
+                    if token == eos or step >= max_new_tokens[i]:
+                        finished[i] = True
+                        yield i, None
+                        continue
+                    tokens[i].append(token)
+                    text = self.tokenizer.decode(tokens[i], skip_special_tokens=True)
+                    if len(text) > len(texts[i]):
+                        yield i, text[len(texts[i]):]
+                        texts[i] = text
+                if all(finished):
+                    return
+                inputs = next_tokens.unsqueeze(-1)
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(prompts), 1))], dim=-1)
+                position_ids = position_ids[:, -1:] + 1
+        for i, done in enumerate(finished):
+            if not done:
+                yield i, None
+
+
+class InferenceEngine:
+    def __init__(self, generator_factory, max_batch_size=8, max_wait=0.02, max_queue=256, max_new_tokens=256):
+        """
+        :param generator_factory: Builds the generator (e.g. TransformersGenerator) on first use, in the worker thread.
+        :param max_batch_size: Most requests decoded together.
+        :param max_wait: Seconds the worker waits for a batch to fill once it has one request.
+        :param max_queue: Pending requests beyond which submit() raises QueueFull.
+        """
+        self.generator_factory = generator_factory
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.max_batch_seen = 0
+        self.tokens = 0
+        self.decode_time = 0.0
+        self._first_token_times = deque(maxlen=1000)
+
+    def submit(self, prompt, on_token, on_done, max_new_tokens=None):
+        """
+        Queues a prompt. on_token(request, piece) is called for every decoded piece of text and
+        on_done(request, error) once, with error None on success; both run on the worker thread.
+        """
+        self._ensure_started()
+        request = GenerationRequest(prompt, on_token, on_done, max_new_tokens or self.max_new_tokens)
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull('The assistant is busy, please try again in a moment.')
+        with self._lock:
+            self.requests += 1
+        return request
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='inference-worker', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        generator = None
+        while True:
+            batch = self._next_batch()
+            try:
+                if generator is None:
+                    generator = self.generator_factory()
+                self._decode(generator, batch)
+            except Exception as e:
+                # Requests that already finished got their on_done; only the others fail.
+                unfinished = [request for request in batch if not request.done]
+                with self._lock:
+                    self.failed += len(unfinished)
+                for request in unfinished:
+                    self._finish(request, e)
+
+    @staticmethod
+    def _finish(request, error):
+        request.done = True
+        request.on_done(request, error)
+
+    def _decode(self, generator, batch):
+        with self._lock:
+            self.batches += 1
+            self.batched_requests += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        started = time.monotonic()
+        tokens = 0
+        open_requests = set(range(len(batch)))
+        for index, piece in iterate(generator.generate([request.prompt for request in batch],
+                                                       [request.max_new_tokens for request in batch])):
+            request = batch[index]
+            if piece is None:
+                open_requests.discard(index)
+                self._finish(request, None)
+                continue
+            if request.first_token_at is None:
+                request.first_token_at = time.monotonic()
+                with self._lock:
+                    self._first_token_times.append(request.first_token_at - request.submitted_at)
+            tokens += 1
+            request.on_token(request, piece)
+        for index in open_requests:
+            self._finish(batch[index], None)
+        with self._lock:
+            self.tokens += tokens
+            self.decode_time += time.monotonic() - started
+
+    def stats(self):
+        with self._lock:
+            first_token = sorted(self._first_token_times)
+
+            def percentile(p):
+                return round(first_token[min(int(len(first_token) * p), len(first_token) - 1)] * 1000, 1) \
+                    if first_token else None
+
+            return {
+                'queue_depth': self._queue.qsize(),
+                'requests': self.requests,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'batches': self.batches,
+                'avg_batch_size': round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+                'max_batch_size': self.max_batch_seen,
+                'ttft_p50_ms': percentile(0.5),
+                'ttft_p95_ms': percentile(0.95),
+                'tokens_per_sec': round(self.tokens / self.decode_time, 1) if self.decode_time else 0.0,
+            }
@@ -0,0 +1,353 @@
+"""
+Streaming ingestion of legal documents (statutes, case law) into documents_collection.
+
+Files are read lazily as a stream of parts (one JSONL record, one PDF page, or a few paragraphs of
+a text file), parts are normalized, sentence-split and chunked in a process pool, and chunks are
+written with ordered insert_many batches. A checkpoint file records which parts are stored, so an
+interrupted run resumes where it stopped; chunk ids are deterministic, so parts replayed after a
+crash do not produce duplicates.
+
+    python -m ai.ingest corpus/ --batch-size 500 --workers 4
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from pymongo.errors import BulkWriteError
+
+from ai.models import models
+
+
+SUPPORTED_EXTENSIONS = ('.txt', '.md', '.jsonl', '.pdf')
+TEXT_PART_SIZE = 64 * 1024
+
+Part = namedtuple('Part', ['source', 'number', 'text', 'metadata'])
+SourceEnd = namedtuple('SourceEnd', ['source'])
+# A record that could not be read; the rest of the file is still ingested.
+Skipped = namedtuple('Skipped', ['source', 'number'])
+
+logger = logging.getLogger(__name__)
+
+
+def iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif path.lower().endswith(SUPPORTED_EXTENSIONS):
+            yield path
+
+
+def _read_text(path, source):
+    """
+    Yields the file in parts of about TEXT_PART_SIZE characters, cut at paragraph breaks. Text without
+    them is cut at the last space once a part reaches four times that, and lines are read at most
+    TEXT_PART_SIZE characters at a time, so memory stays flat even for a file that is one long line.
+    """
+    buffer, size, number = [], 0, 0
+    with open(path, encoding='utf-8', errors='replace') as f:
+        while True:
+            line = f.readline(TEXT_PART_SIZE)
+            if not line:
+                break
+            buffer.append(line)
+            size += len(line)
+            if size >= TEXT_PART_SIZE and not line.strip():
+                yield Part(source, number, ''.join(buffer), {})
+                buffer, size, number = [], 0, number + 1
+            elif size >= TEXT_PART_SIZE * 4:
+                text = ''.join(buffer)
+                cut = max(text.rfind(' '), text.rfind('\n'), text.rfind('\t')) + 1 or len(text)
+                yield Part(source, number, text[:cut], {})
+                buffer, size, number = [text[cut:]], len(text) - cut, number + 1
+    if size:
+        yield Part(source, number, ''.join(buffer), {})
+
+
+def _read_jsonl(path, source):
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning('%s line %d: skipped, not valid JSON (%s)', path, number + 1, e)
+                yield Skipped(source, number)
+                continue
+            text = record.pop('text', None) or record.pop('content', None) or record.pop('body', '')
+            yield Part(source, number, text, record)
+
+
+def _read_pdf(path, source):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError(f'{path}: PDF ingestion needs the optional pypdf package')
+    reader = PdfReader(path)
+    for number, page in enumerate(reader.pages):
+        yield Part(source, number, page.extract_text() or '', {'page': number + 1})
+
+
+def iter_parts(paths, checkpoint=None, root=None):
+    """
+    Streams every part of every file, skipping the ones the checkpoint already has, with a Skipped for
+    each record that could not be read and a SourceEnd after each file.
+    """
+    checkpoint = checkpoint or {}
+    for path in iter_files(paths):
+        source = os.path.relpath(path, root) if root else path
+        state = checkpoint.get(source, {})
+        if state.get('done'):
+            continue
+        last_part = state.get('part', -1)
+        lower = path.lower()
+        if lower.endswith('.jsonl'):
+            parts = _read_jsonl(path, source)
+        elif lower.endswith('.pdf'):
+            parts = _read_pdf(path, source)
+        else:
+            parts = _read_text(path, source)
+        for part in parts:
+            if part.number > last_part:
+                yield part
+        yield SourceEnd(source)
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKC', text)
+    # Words hyphenated across line breaks by the typesetting.
+    text = re.sub(r'(\w)-\n(\w)', r'\1\2', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def chunk_sentences(sentences, chunk_size, overlap):
+    """
+    Groups sentences into chunks of at most `chunk_size` words; each chunk repeats the trailing
+    sentences of the previous one, up to `overlap` words. A sentence longer than `chunk_size` is
+    a chunk by itself.
+    """
+    chunks, current, words, fresh = [], [], 0, False
+    for sentence in sentences:
+        length = len(sentence.split())
+        if fresh and words + length > chunk_size:
+            chunks.append(' '.join(current))
+            kept, kept_words = [], 0
+            for previous in reversed(current):
+                previous_words = len(previous.split())
+                if kept_words + previous_words > overlap:
+                    break
+                kept.insert(0, previous)
+                kept_words += previous_words
+            while kept and kept_words + length > chunk_size:
+                kept_words -= len(kept.pop(0).split())
+            current, words = kept, kept_words
+        current.append(sentence)
+        words += length
+        fresh = True
+    if fresh:
+        chunks.append(' '.join(current))
+    return chunks
+
+
+def process_part(part, chunk_size, overlap):
+    """Runs in a pool worker: returns the chunk documents of one part."""
+    text = normalize(part.text)
+    if not text:
+        return part, []
+    sentences = [sentence.strip() for sentence in models.get('sentence_splitter')(text) if sentence.strip()]
+    documents = []
+    for index, chunk in enumerate(chunk_sentences(sentences, chunk_size, overlap)):
+        documents.append({
+            '_id': f'{part.source}:{part.number}:{index}',
+            'source': part.source,
+            'part': part.number,
+            'chunk': index,
+            'text': chunk,
+            'words': len(chunk.split()),
+            'metadata': part.metadata,
+        })
+    return part, documents
+
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    if not path:
+        return
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(temporary, path)
+
+
+class Ingestor:
+    """Writes chunk documents in ordered batches and advances the checkpoint as batches land."""
+
+    def __init__(self, collection, batch_size=500, checkpoint_path=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = load_checkpoint(checkpoint_path)
+
+        self._buffer = []
+        # (source, part number or None for end of source, chunks of it still in the buffer)
+        self._pending = deque()
+
+        self.parts = 0
+        self.chunks = 0
+        self.batches = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    def add(self, part, documents):
+        self.parts += 1
+        self._pending.append([part.source, part.number, len(documents)])
+        self._buffer.extend(documents)
+        while len(self._buffer) >= self.batch_size:
+            self._flush(self.batch_size)
+
+    def end_source(self, source):
+        self._pending.append([source, None, 0])
+
+    def _insert(self, batch):
+        try:
+            self.collection.insert_many(batch, ordered=True)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error['code'] != 11000 for error in errors):
+                raise
+            # Chunks replayed after an interrupted run are already stored; write the rest of the batch.
+            rest = batch[errors[0]['index'] + 1:]
+            if rest:
+                try:
+                    self.collection.insert_many(rest, ordered=False)
+                except BulkWriteError as e:
+                    if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                        raise
+
+    def _flush(self, count):
+        batch, self._buffer = self._buffer[:count], self._buffer[count:]
+        if batch:
+            ingested_at = datetime.now(timezone.utc)
+            for document in batch:
+                document['ingested_at'] = ingested_at
+            self._insert(batch)
+            self.batches += 1
+            self.chunks += len(batch)
+
+        written = len(batch)
+        while self._pending:
+            entry = self._pending[0]
+            taken = min(entry[2], written)
+            entry[2] -= taken
+            written -= taken
+            if entry[2]:
+                break
+            self._pending.popleft()
+            source, number, _ = entry
+            state = self.checkpoint.setdefault(source, {})
+            if number is None:
+                state['done'] = True
+            else:
+                state['part'] = number
+        save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+    def close(self):
+        self._flush(len(self._buffer))
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'parts': self.parts,
+            'chunks': self.chunks,
+            'batches': self.batches,
+            'skipped_records': self.skipped,
+            'seconds': round(elapsed, 3),
+            'chunks_per_sec': round(self.chunks / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+def ingest(paths, collection, batch_size=500, chunk_size=200, overlap=40, workers=None, checkpoint_path=None,
+           root=None):
+    """
+    Ingests every supported file under `paths`. At most a few parts per worker are in flight at any
+    time, so memory use does not depend on the size of the corpus.
+    """
+    workers = workers or os.cpu_count() or 1
+    ingestor = Ingestor(collection, batch_size=batch_size, checkpoint_path=checkpoint_path)
+    collection.create_index('source')
+    collection.create_index([('ingested_at', 1), ('_id', 1)])
+
+    in_flight = deque()
+    window = workers * 4
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def drain(limit):
+            while len(in_flight) > limit:
+                item = in_flight.popleft()
+                if isinstance(item, SourceEnd):
+                    ingestor.end_source(item.source)
+                else:
+                    ingestor.add(*item.result())
+
+        for item in iter_parts(paths, ingestor.checkpoint, root=root):
+            if isinstance(item, Skipped):
+                ingestor.skipped += 1
+                continue
+            if isinstance(item, SourceEnd):
+                in_flight.append(item)
+            else:
+                in_flight.append(pool.submit(process_part, item, chunk_size, overlap))
+            drain(window)
+        drain(0)
+    ingestor.close()
+    return ingestor.stats()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ingest legal documents into documents_collection.')
+    parser.add_argument('paths', nargs='+', help='files or directories (.txt, .md, .jsonl, .pdf)')
+    parser.add_argument('--batch-size', type=int, default=500, help='chunks per insert_many call')
+    parser.add_argument('--chunk-size', type=int, default=200, help='maximum words per chunk')
+    parser.add_argument('--overlap', type=int, default=40, help='words repeated between consecutive chunks')
+    parser.add_argument('--workers', type=int, default=None, help='parser processes (default: CPU count)')
+    parser.add_argument('--checkpoint', default='.ingest_checkpoint.json',
+                        help='resume file; pass an empty string to disable')
+    parser.add_argument('--vector-index', help='vector index directory to append the new chunks to')
+    parser.add_argument('--model', default='sentence-transformers/all-MiniLM-L6-v2',
+                        help="embedding model for --vector-index; transformers name or 'gensim:/path/to/vectors.kv'")
+    args = parser.parse_args(argv)
+
+    from database.mongo_db.mongo_connect import mongo_collection
+
+    root = os.path.commonpath([os.path.abspath(path) for path in args.paths])
+    if os.path.isfile(root):
+        root = os.path.dirname(root)
+    stats = ingest(args.paths, mongo_collection, batch_size=args.batch_size, chunk_size=args.chunk_size,
+                   overlap=args.overlap, workers=args.workers, checkpoint_path=args.checkpoint or None, root=root)
+    if args.vector_index:
+        from ai.vector_index import VectorIndex, load_embedder, sync_from_collection
+
+        embedder = load_embedder(args.model)
+        stats['vectors_added'] = sync_from_collection(VectorIndex(args.vector_index, dim=embedder.dim),
+                                                      mongo_collection, embedder)
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Registry of the heavy ML models (transformers, spaCy, gensim, nltk).
+
+Importing this module is cheap: each model is a factory that imports its library and loads its
+weights the first time get() asks for it, so a web worker that never answers a question never
+pays for torch. A pre-fork server can call preload() in the master process instead; the loaded
+weights are then shared copy-on-write by every forked worker.
+"""
+import gc
+import re
+import threading
+import time
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._factories = {}
+        self._models = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.load_seconds = {}
+
+    def register(self, name, factory):
+        with self._lock:
+            self._factories[name] = factory
+            self._locks[name] = threading.Lock()
+            self._models.pop(name, None)
+
+    def get(self, name):
+        """Returns the model, loading it on first use. Concurrent callers wait for a single load."""
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        if name not in self._factories:
+            raise KeyError(f'No model registered as {name!r}')
+        with self._locks[name]:
+            model = self._models.get(name)
+            if model is None:
+                started = time.perf_counter()
+                model = self._models[name] = self._factories[name]()
+                self.load_seconds[name] = round(time.perf_counter() - started, 3)
+        return model
+
+    def loaded(self, name):
+        return name in self._models
+
+    def preload(self, names):
+        """
+        Loads `names` now. Called before the server forks, the weights end up in pages the workers
+        share; gc.freeze() keeps the collector from touching those objects and un-sharing them.
+        """
+        for name in names:
+            self.get(name)
+        if names:
+            gc.freeze()
+
+    def stats(self):
+        return {'registered': sorted(self._factories), 'loaded': sorted(self._models),
+                'load_seconds': dict(self.load_seconds)}
+
+
+def load_sentence_splitter():
+    """spaCy's rule-based sentencizer (no model download), else NLTK punkt, else a regex."""
+    try:
+        import spacy
+
+        from ai.ingest import TEXT_PART_SIZE
+
+        nlp = spacy.blank('en')
+        nlp.add_pipe('sentencizer')
+        nlp.max_length = TEXT_PART_SIZE * 4
+        return lambda text: [sentence.text for sentence in nlp(text).sents]
+    except ImportError:
+        try:
+            import nltk
+
+            nltk.data.find('tokenizers/punkt')
+            return nltk.sent_tokenize
+        except (ImportError, LookupError):
+            return re.compile(r'(?<=[.!?;])\s+(?=[A-Z0-9À-ɏЀ-ӿ(§])').split
+
+
+models = ModelRegistry()
+models.register('sentence_splitter', load_sentence_splitter)
+
+
+def configure(app):
+    """Registers the models whose names come from the app config."""
+
+    def generator():
+        from ai.inference import TransformersGenerator
+
+        return TransformersGenerator(app.config['INFERENCE_MODEL'])
+
+    def embedder():
+        from ai.vector_index import load_embedder
+
+        return load_embedder(app.config['EMBEDDING_MODEL'])
+
+    def tokenizer():
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(app.config['INFERENCE_MODEL'])
+
+    models.register('generator', generator)
+    models.register('embedder', embedder)
+    models.register('tokenizer', tokenizer)
+    return models
@@ -0,0 +1,384 @@
+"""
+Vector retrieval index over documents_collection.
+
+Embeddings are L2-normalized float32 rows in one contiguous file, opened with np.memmap so every
+worker process on the host shares the same page-cached copy. Search is batched brute-force cosine
+similarity, or IVF (k-means partitions, probing the `nprobe` nearest ones) once build_ivf() has run.
+New chunks are appended without rewriting the file; rows added after the last IVF build are
+searched exhaustively until the next build.
+
+    python -m ai.vector_index build data/index --model sentence-transformers/all-MiniLM-L6-v2
+    python -m ai.vector_index ivf data/index --lists 1024
+
+`python -m ai.ingest --vector-index data/index ...` appends the chunks it ingests. With
+VECTOR_INDEX_DIR set, the assistant takes its passages from Retriever instead of BM25.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from cooperative import offload
+
+
+BLOCK_ROWS = 65536
+
+
+def normalize_rows(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class TransformerEmbedder:
+    """Mean-pooled sentence embeddings from a transformers encoder, run on CPU."""
+
+    def __init__(self, model_name='sentence-transformers/all-MiniLM-L6-v2', max_length=256, batch_size=32):
+        from transformers import AutoModel, AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name)
+        self.model.eval()
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.dim = self.model.config.hidden_size
+
+    def embed(self, texts):
+        import torch
+
+        rows = []
+        with torch.inference_mode():
+            for start in range(0, len(texts), self.batch_size):
+                encoded = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True,
+                                         max_length=self.max_length, return_tensors='pt')
+                hidden = self.model(**encoded).last_hidden_state
+                mask = encoded['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+                rows.append(((hidden * mask).sum(1) / mask.sum(1).clamp(min=1e-9)).numpy())
+        return normalize_rows(np.concatenate(rows)) if rows else np.empty((0, self.dim), np.float32)
+
+
+class GensimEmbedder:
+    """Average of the word vectors of a gensim KeyedVectors model."""
+
+    def __init__(self, path):
+        from gensim.models import KeyedVectors
+        from gensim.utils import simple_preprocess
+
+        self.vectors = KeyedVectors.load(path, mmap='r')
+        self.tokenize = simple_preprocess
+        self.dim = self.vectors.vector_size
+
+    def embed(self, texts):
+        rows = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = [word for word in self.tokenize(text) if word in self.vectors.key_to_index]
+            if words:
+                rows[i] = self.vectors[words].mean(axis=0)
+        return normalize_rows(rows)
+
+
+def load_embedder(spec):
+    """'gensim:/path/to/vectors.kv' or a transformers model name."""
+    if spec.startswith('gensim:'):
+        return GensimEmbedder(spec[len('gensim:'):])
+    return TransformerEmbedder(spec)
+
+
+def _top_k(scores, k, offset=0):
+    """Row-wise top-k (indices, scores) of a (queries, rows) score block, best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), np.int64), np.empty((scores.shape[0], 0), np.float32)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part, order, axis=1) + offset, np.take_along_axis(part_scores, order, axis=1)
+
+
+def _merge(best_ids, best_scores, ids, scores, k):
+    if best_ids is None:
+        return ids, scores
+    ids = np.concatenate([best_ids, ids], axis=1)
+    scores = np.concatenate([best_scores, scores], axis=1)
+    order = np.argsort(-scores, axis=1)[:, :k]
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+class VectorIndex:
+    """
+    On-disk layout of `directory`:
+        meta.json        dim, row count, ingestion cursor, IVF row count
+        vectors.f32      row-major float32 matrix, `count` rows of `dim`
+        ids.txt          documents_collection _id of every row, one per line
+        centroids.npy, ivf_order.npy, ivf_offsets.npy   IVF partitions (optional)
+        ivf_vectors.f32  the rows again, grouped by partition, so each probed list is one contiguous read
+    """
+
+    def __init__(self, directory, dim=None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        meta = self._read_meta()
+        if meta is None:
+            if dim is None:
+                raise ValueError(f'{directory} has no index yet; pass dim to create one')
+            meta = {'dim': dim, 'count': 0, 'ids_bytes': 0, 'cursor': None, 'ivf_count': 0}
+            self._write_meta(meta)
+        self.meta = meta
+        self.dim = meta['dim']
+        self._mtime = None
+        self._matrix = None
+        self._ids = []
+        self._centroids = None
+        self._ivf_order = None
+        self._ivf_offsets = None
+        self._ivf_vectors = None
+        self.refresh()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_meta(self):
+        try:
+            with open(self._path('meta.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _replace(self, name, write):
+        """
+        Writes a file under a temporary name and renames it over `name`, so a process that has the old
+        one mapped keeps reading it instead of seeing it truncated.
+        """
+        temporary = self._path(name + '.tmp')
+        with open(temporary, 'wb') as f:
+            write(f)
+        os.replace(temporary, self._path(name))
+
+    def _write_meta(self, meta):
+        temporary = self._path('meta.json.tmp')
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temporary, self._path('meta.json'))
+
+    def refresh(self):
+        """Re-maps the files if another process appended to the index or rebuilt the IVF lists."""
+        mtime = os.stat(self._path('meta.json')).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        self.meta = self._read_meta()
+        count = self.meta['count']
+        self._matrix = np.memmap(self._path('vectors.f32'), dtype=np.float32, mode='r',
+                                 shape=(count, self.dim)) if count else np.empty((0, self.dim), np.float32)
+        with open(self._path('ids.txt'), 'a+b') as f:
+            f.seek(0)
+            self._ids = f.read(self.meta['ids_bytes']).decode('utf-8').splitlines()
+        if self.meta['ivf_count']:
+            self._centroids = np.load(self._path('centroids.npy'))
+            self._ivf_order = np.load(self._path('ivf_order.npy'), mmap_mode='r')
+            self._ivf_offsets = np.load(self._path('ivf_offsets.npy'))
+            self._ivf_vectors = np.memmap(self._path('ivf_vectors.f32'), dtype=np.float32, mode='r',
+                                          shape=(self.meta['ivf_count'], self.dim))
+        else:
+            self._centroids = self._ivf_order = self._ivf_offsets = self._ivf_vectors = None
+        self._mtime = mtime
+
+    def __len__(self):
+        return self.meta['count']
+
+    def append(self, ids, vectors, cursor=None):
+        """
+        Appends rows. meta.json is updated last, so readers never map a partly written row, and the
+        data files are first cut back to what meta.json covers in case an earlier append crashed.
+        Only one process should append at a time.
+        """
+        vectors = normalize_rows(vectors)
+        if vectors.shape != (len(ids), self.dim):
+            raise ValueError(f'expected {len(ids)} vectors of dimension {self.dim}, got {vectors.shape}')
+        meta = self._read_meta()
+        encoded_ids = ''.join(f'{doc_id}\n' for doc_id in ids).encode('utf-8')
+        with open(self._path('vectors.f32'), 'ab') as f:
+            f.truncate(meta['count'] * self.dim * 4)
+            f.write(vectors.tobytes())
+        with open(self._path('ids.txt'), 'ab') as f:
+            f.truncate(meta['ids_bytes'])
+            f.write(encoded_ids)
+        meta['count'] += len(ids)
+        meta['ids_bytes'] += len(encoded_ids)
+        if cursor is not None:
+            meta['cursor'] = cursor
+        self._write_meta(meta)
+        self.refresh()
+
+    def build_ivf(self, lists=1024, sample=100000, iterations=10, seed=0):
+        """Partitions the current rows with k-means over a sample; rows appended later are scanned exhaustively."""
+        count = len(self)
+        lists = max(1, min(lists, count))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(count, size=min(sample, count), replace=False))
+        training = np.asarray(self._matrix[sample_rows])
+        centroids = training[rng.choice(len(training), size=lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(training @ centroids.T, axis=1)
+            for list_id in range(lists):
+                members = training[assignment == list_id]
+                if len(members):
+                    centroids[list_id] = members.mean(axis=0)
+            centroids = normalize_rows(centroids)
+
+        assignment = np.empty(count, dtype=np.int32)
+        for start in range(0, count, BLOCK_ROWS):
+            block = np.asarray(self._matrix[start:start + BLOCK_ROWS])
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=lists))]).astype(np.int64)
+
+        def write_vectors(f):
+            for start in range(0, count, BLOCK_ROWS):
+                f.write(np.asarray(self._matrix[order[start:start + BLOCK_ROWS]]).tobytes())
+
+        self._replace('ivf_vectors.f32', write_vectors)
+        self._replace('ivf_order.npy', lambda f: np.save(f, order))
+        self._replace('ivf_offsets.npy', lambda f: np.save(f, offsets))
+        self._replace('centroids.npy', lambda f: np.save(f, centroids))
+        # meta.json goes last: other processes re-map the IVF files only once all of them are in place.
+        meta = self._read_meta()
+        meta['ivf_count'] = count
+        self._write_meta(meta)
+        self.refresh()
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+        Top-k cosine search for a batch of query vectors.
+        :param queries: (n, dim) array, or a single (dim,) vector.
+        :param nprobe: IVF partitions to scan per query; None scans every row.
+        :return: (row indices, scores), each (n, k), best first. Map rows to ids with `ids_for`.
+        """
+        self.refresh()
+        queries = normalize_rows(np.atleast_2d(queries))
+        if nprobe is None or self._centroids is None:
+            return self._exhaustive(queries, k, 0, len(self))
+
+        ivf_count = self.meta['ivf_count']
+        tail_ids, tail_scores = self._exhaustive(queries, k, ivf_count, len(self))
+        probes = np.argsort(-(queries @ self._centroids.T), axis=1)[:, :nprobe]
+        candidate_ids = [[tail_ids[q]] for q in range(len(queries))]
+        candidate_scores = [[tail_scores[q]] for q in range(len(queries))]
+        # Each probed list is scored once against every query that probes it.
+        for list_id in np.unique(probes):
+            start, stop = self._ivf_offsets[list_id], self._ivf_offsets[list_id + 1]
+            if start == stop:
+                continue
+            probing = np.nonzero((probes == list_id).any(axis=1))[0]
+            positions, scores = _top_k(queries[probing] @ self._ivf_vectors[start:stop].T, k)
+            rows = np.asarray(self._ivf_order[start:stop])[positions]
+            for j, q in enumerate(probing):
+                candidate_ids[q].append(rows[j])
+                candidate_scores[q].append(scores[j])
+
+        all_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q in range(len(queries)):
+            ids, scores = np.concatenate(candidate_ids[q]), np.concatenate(candidate_scores[q])
+            best = np.argsort(-scores)[:k]
+            all_ids[q, :len(best)] = ids[best]
+            all_scores[q, :len(best)] = scores[best]
+        return all_ids, all_scores
+
+    def _exhaustive(self, queries, k, start, stop):
+        best_ids = best_scores = None
+        for block_start in range(start, stop, BLOCK_ROWS):
+            block = self._matrix[block_start:min(block_start + BLOCK_ROWS, stop)]
+            ids, scores = _top_k(queries @ block.T, k, block_start)
+            best_ids, best_scores = _merge(best_ids, best_scores, ids, scores, k)
+        if best_ids is None:
+            return np.empty((len(queries), 0), np.int64), np.empty((len(queries), 0), np.float32)
+        return best_ids, best_scores
+
+    def ids_for(self, rows):
+        return [self._ids[row] for row in rows if row >= 0]
+
+
+def sync_from_collection(index, collection, embedder, batch_size=256):
+    """
+    Embeds the chunks ingested after the index's cursor, in ingestion order, and appends them.
+    The cursor is the (ingested_at, _id) of the last indexed chunk, as in keyset pagination.
+    """
+    added = 0
+    while True:
+        query = {}
+        cursor = index.meta.get('cursor')
+        if cursor:
+            ingested_at = datetime.fromisoformat(cursor['ingested_at'])
+            query = {'$or': [{'ingested_at': {'$gt': ingested_at}},
+                             {'ingested_at': ingested_at, '_id': {'$gt': cursor['_id']}}]}
+        documents = list(collection.find(query, {'text': 1, 'ingested_at': 1})
+                         .sort([('ingested_at', 1), ('_id', 1)]).limit(batch_size))
+        if not documents:
+            return added
+        vectors = embedder.embed([document['text'] for document in documents])
+        last = documents[-1]
+        index.append([document['_id'] for document in documents], vectors,
+                     cursor={'ingested_at': last['ingested_at'].isoformat(), '_id': last['_id']})
+        added += len(documents)
+
+
+class Retriever:
+    """Embeds questions and returns the best matching chunks from documents_collection."""
+
+    def __init__(self, index, embedder, collection, nprobe=None):
+        """
+        :param embedder: Callable returning the embedder, so the model loads on the first question.
+        """
+        self.index = index
+        self.embedder = embedder
+        self.collection = collection
+        self.nprobe = nprobe
+
+    def _search(self, embedder, questions, k):
+        return self.index.search(embedder.embed(questions), k=k, nprobe=self.nprobe)
+
+    def retrieve(self, questions, k=5):
+        # Picks up the rows an ingestion run appended since the last question.
+        self.index.refresh()
+        rows, scores = offload(self._search, self.embedder(), questions, k)
+        wanted = [self.index.ids_for(row) for row in rows]
+        found = {document['_id']: document for document in
+                 self.collection.find({'_id': {'$in': [doc_id for ids in wanted for doc_id in ids]}})}
+        return [[dict(found[doc_id], score=float(score)) for doc_id, score in zip(ids, row_scores) if doc_id in found]
+                for ids, row_scores in zip(wanted, scores)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build and maintain the document vector index.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='embed chunks ingested since the last run and append them')
+    build.add_argument('directory')
+    build.add_argument('--model', default='sentence-transformers/all-MiniLM-L6-v2',
+                       help="transformers model name, or 'gensim:/path/to/vectors.kv'")
+    build.add_argument('--batch-size', type=int, default=256)
+    ivf = commands.add_parser('ivf', help='(re)build the IVF partitions')
+    ivf.add_argument('directory')
+    ivf.add_argument('--lists', type=int, default=1024)
+    ivf.add_argument('--sample', type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    if args.command == 'build':
+        from database.mongo_db.mongo_connect import mongo_collection
+
+        embedder = load_embedder(args.model)
+        index = VectorIndex(args.directory, dim=embedder.dim)
+        added = sync_from_collection(index, mongo_collection, embedder, batch_size=args.batch_size)
+        print(json.dumps({'added': added, 'rows': len(index), 'seconds': round(time.perf_counter() - started, 3)}))
+    else:
+        index = VectorIndex(args.directory)
+        index.build_ivf(lists=args.lists, sample=args.sample)
+        print(json.dumps({'rows': len(index), 'lists': args.lists, 'seconds': round(time.perf_counter() - started, 3)}))
+
+
+if __name__ == '__main__':
+    main()
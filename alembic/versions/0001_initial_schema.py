@@ -0,0 +1,46 @@
+"""Initial schema: users and posts
+
+Revision ID: 0001
+Revises:
+Create Date: 2024-03-01 00:00:00
+
+Databases created before migrations existed already have these tables; mark them as migrated with
+`alembic stamp 0001` and run `alembic upgrade head` from there.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('username', sa.String(length=50), nullable=False, unique=True),
+        sa.Column('email', sa.String(length=50), nullable=False, unique=True),
+        sa.Column('password', sa.String(length=250), nullable=False),
+        sa.Column('image_file', sa.String(length=40), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('is_active', sa.Boolean(), nullable=True),
+    )
+    op.create_table(
+        'posts',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('title', sa.String(length=250), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('description', sa.String(length=900), nullable=False),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id', ondelete='CASCADE'), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('posts')
+    op.drop_table('users')
@@ -0,0 +1,32 @@
+"""Add users.post_count and index posts for the listing pages
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2024-03-15 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('post_count', sa.Integer(), nullable=False, server_default='0'))
+    op.execute('UPDATE users SET post_count = '
+               '(SELECT COUNT(*) FROM posts WHERE posts.user_id = users.id)')
+    op.create_index('ix_posts_user_id_created_at_id', 'posts', ['user_id', 'created_at', 'id'])
+    op.create_index('ix_posts_created_at_id', 'posts', ['created_at', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_created_at_id', table_name='posts')
+    op.drop_index('ix_posts_user_id_created_at_id', table_name='posts')
+    op.drop_column('users', 'post_count')
@@ -0,0 +1,142 @@
+"""
+Profile picture pipeline.
+
+An upload is identified by the SHA-256 of its bytes; the account page stores that digest in
+User.image_file and hands decoding and resizing to a process pool, so the request only reads and
+hashes the file. Every size is written as WebP and JPEG, named after the digest, so identical
+uploads share the same files and the files never change: they are served with a one year,
+immutable Cache-Control. Files no user refers to any more are removed by `python -m avatars gc`.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+
+AVATAR_SIZES = {'sm': 65, 'md': 130, 'lg': 250}
+FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+DIGEST_LENGTH = 32
+
+
+def avatar_filename(digest, size, extension):
+    return f'{digest}-{size}.{extension}'
+
+
+def is_digest(image_file):
+    """Pictures uploaded before the pipeline (and default.jpg) are plain file names with an extension."""
+    return '.' not in image_file
+
+
+def render_avatar(data, directory, digest, sizes=None):
+    """Runs in a pool worker: decodes the upload once and writes every size in every format."""
+    sizes = sizes or AVATAR_SIZES
+    largest = max(sizes.values())
+    image = Image.open(io.BytesIO(data))
+    # For JPEG, draft() makes the decoder scale by 1/2, 1/4 or 1/8 while decoding, which is far
+    # cheaper than decoding the full photo and shrinking it afterwards.
+    image.draft('RGB', (largest * 2, largest * 2))
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    for size, pixels in sizes.items():
+        resized = ImageOps.fit(image, (pixels, pixels), Image.LANCZOS)
+        for extension, image_format in FORMATS.items():
+            path = os.path.join(directory, avatar_filename(digest, size, extension))
+            temporary = f'{path}.{os.getpid()}.tmp'
+            resized.save(temporary, image_format, quality=85, optimize=True)
+            os.replace(temporary, path)
+    return digest
+
+
+class AvatarPipeline:
+    def __init__(self, directory, workers=2, sizes=None):
+        self.directory = directory
+        self.workers = workers
+        self.sizes = sizes or AVATAR_SIZES
+        self._pool = None
+        self._pid = None
+        self._pending = {}
+
+    @classmethod
+    def from_app(cls, app):
+        directory = app.config.get('AVATAR_DIR') or os.path.join(app.root_path, 'static', 'profile_pics')
+        return cls(directory, workers=int(app.config.get('AVATAR_WORKERS', 2)))
+
+    def _executor(self):
+        if self._pid != os.getpid():
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self._pid = os.getpid()
+            self._pending = {}
+        return self._pool
+
+    def rendered(self, digest):
+        return all(os.path.exists(os.path.join(self.directory, avatar_filename(digest, size, extension)))
+                   for size in self.sizes for extension in FORMATS)
+
+    def submit(self, upload):
+        """
+        Hashes the upload, checks that it is an image, and queues the resizing unless these exact
+        bytes were processed before.
+        :return: The digest to store in User.image_file.
+        """
+        data = upload.read()
+        digest = hashlib.sha256(data).hexdigest()[:DIGEST_LENGTH]
+        # Only reads the header; a file Pillow cannot identify is rejected before it reaches the pool.
+        Image.open(io.BytesIO(data))
+        if digest not in self._pending and not self.rendered(digest):
+            future = self._executor().submit(render_avatar, data, self.directory, digest, self.sizes)
+            self._pending[digest] = future
+            future.add_done_callback(lambda _: self._pending.pop(digest, None))
+        return digest
+
+    def wait(self, timeout=None):
+        for future in list(self._pending.values()):
+            future.result(timeout)
+
+
+def collect_garbage(directory, referenced, min_age=3600):
+    """
+    Deletes the pictures no user refers to. Files younger than `min_age` seconds are kept, so a
+    picture whose account update is still in flight is not removed under it.
+    :param referenced: Every User.image_file value.
+    """
+    referenced = set(referenced) | {'default.jpg'}
+    removed = 0
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.tmp') or not os.path.isfile(path):
+            continue
+        stem, extension = os.path.splitext(name)
+        digest = stem.rsplit('-', 1)[0] if extension[1:] in FORMATS and '-' in stem else None
+        if name in referenced or digest in referenced:
+            continue
+        if now - os.path.getmtime(path) < min_age:
+            continue
+        os.remove(path)
+        removed += 1
+    return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain the stored profile pictures.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    gc = commands.add_parser('gc', help='delete pictures no user refers to')
+    gc.add_argument('--min-age', type=int, default=3600, help='seconds a file is kept even if unreferenced')
+    args = parser.parse_args(argv)
+
+    from system import app, avatar_pipeline
+    from database.sql_db.connect import session_db
+    from database.sql_db.models import User
+
+    with app.app_context():
+        referenced = [image_file for image_file, in session_db.query(User.image_file)]
+    removed = collect_garbage(avatar_pipeline.directory, referenced, min_age=args.min_age)
+    print(json.dumps({'removed': removed, 'referenced': len(set(referenced))}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Server-side cost of chat fan-out: how many messages per second one room takes, per room size, when
+every message is its own event (as before RoomBroadcaster) and when messages go out in
+RoomBroadcaster batches, as JSON and as msgpack.
+
+A bare Flask-SocketIO server gets `size` participants in one room. Each recipient's engine.io send
+is replaced by encoding the packet, the work a real connection does before writing it, so the
+numbers are CPU only, without the network. Messages are published as fast as possible, so batches
+are as large as --batch; with live traffic a batch holds what arrives within the window.
+
+    python benchmarks/chat_broadcast.py --sizes 10 100 1000 --messages 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ROOM = 'AAAA'
+
+
+def build_server(size):
+    from flask import Flask
+    from flask_socketio import SocketIO
+
+    socketio = SocketIO(Flask(__name__), async_mode='threading')
+    sent = {'packets': 0, 'bytes': 0}
+
+    def send_packet(eio_sid, eio_packet):
+        encoded = eio_packet.encode()
+        sent['packets'] += 1
+        sent['bytes'] += len(encoded)
+
+    socketio.server.eio.send_packet = send_packet
+    for index in range(size):
+        sid = socketio.server.manager.connect(f'eio-{index}', '/')
+        socketio.server.manager.enter_room(sid, '/', ROOM)
+    return socketio, sent
+
+
+def run(mode, size, messages, batch):
+    from chat.broadcast import RoomBroadcaster
+
+    socketio, sent = build_server(size)
+    contents = [{'seq': seq, 'name': f'user{seq % 7}', 'message': f'Is clause {seq} of the lease enforceable?',
+                 'ts': 1700000000.0 + seq} for seq in range(messages)]
+
+    started = time.perf_counter()
+    if mode == 'per_message':
+        for content in contents:
+            socketio.emit('message', content, to=ROOM)
+    else:
+        broadcaster = RoomBroadcaster(socketio, window=60, max_batch=batch,
+                                      encoding='msgpack' if mode == 'batched_msgpack' else 'json')
+        for content in contents:
+            broadcaster.publish(ROOM, content)
+        broadcaster.flush()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'messages_per_sec': round(messages / elapsed, 1),
+        'deliveries_per_sec': round(messages * size / elapsed, 1),
+        'packets': sent['packets'],
+        'bytes_per_delivery': round(sent['bytes'] / (messages * size), 1),
+        'seconds': round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000], help='room members')
+    parser.add_argument('--messages', type=int, default=2000, help='messages published per run')
+    parser.add_argument('--batch', type=int, default=100, help='RoomBroadcaster max_batch')
+    parser.add_argument('--modes', nargs='+', choices=['per_message', 'batched_json', 'batched_msgpack'],
+                        default=['per_message', 'batched_json', 'batched_msgpack'])
+    args = parser.parse_args()
+
+    report = {'settings': vars(args), 'results': {}}
+    for size in args.sizes:
+        report['results'][size] = {mode: run(mode, size, args.messages, args.batch) for mode in args.modes}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
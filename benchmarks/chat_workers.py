@@ -0,0 +1,188 @@
+"""
+Checks that chat rooms stay correct when the app runs in several worker processes.
+
+1. Member counts: WORKERS processes join and leave one room concurrently through the shared
+   SQLite room registry; the final count has to match exactly.
+2. Delivery: WORKERS processes serve main.py with the shared registry and the Socket.IO message
+   queue, one Socket.IO client connects to each of them, and every client has to receive the
+   messages sent through all the others.
+
+Usage:
+    python benchmarks/chat_workers.py --message-queue sqlite:////tmp/chat_queue.db
+    python benchmarks/chat_workers.py --message-queue redis://localhost:6379/0
+
+Without --message-queue (or SOCKETIO_MESSAGE_QUEUE) only the member count check runs.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ROOM = 'BENCH'
+
+
+def unpack(batch):
+    """A "messages" event carries a list of messages, or the list msgpack-packed."""
+    if isinstance(batch, bytes):
+        import msgpack
+
+        return msgpack.unpackb(batch)
+    return batch
+
+
+def churn(path, cycles, start):
+    from chat.registry import SQLiteRoomRegistry
+
+    registry = SQLiteRoomRegistry(path)
+    start.wait()
+    for _ in range(cycles):
+        registry.join(ROOM)
+        registry.join(ROOM)
+        registry.leave(ROOM)
+
+
+def check_members(workers, cycles, directory):
+    from chat.registry import SQLiteRoomRegistry
+
+    path = os.path.join(directory, 'rooms.db')
+    registry = SQLiteRoomRegistry(path)
+    registry.create(ROOM)
+    # One member that never leaves keeps the room alive through the churn.
+    registry.join(ROOM)
+
+    start = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=churn, args=(path, cycles, start)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    began = time.perf_counter()
+    start.set()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - began
+
+    expected = 1 + workers * cycles
+    members = registry.members(ROOM)
+    return {'expected': expected, 'members': members, 'ok': members == expected,
+            'ops_per_sec': round(workers * cycles * 3 / elapsed, 1)}
+
+
+def chat_server(port, environment):
+    os.environ.update(environment)
+    import main
+    from database.sql_db.connect import engine
+
+    engine.echo = False
+    try:
+        import mongomock
+        main.chat_history.collection = mongomock.MongoClient().lawyer_database.chat_messages
+    except ImportError:
+        pass
+    main.socketio.run(main.app, port=port, allow_unsafe_werkzeug=True, log_output=False)
+
+
+def session_cookie(secret_key, name):
+    """Signs the Flask session the chat handlers read the room and the name from."""
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.secret_key = secret_key
+    return app.session_interface.get_signing_serializer(app).dumps({'room': ROOM, 'name': name})
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'worker on port {port} did not start')
+
+
+def check_delivery(workers, message_queue, directory, base_port):
+    import socketio
+    from chat.registry import registry_from_url
+
+    environment = {
+        'SOCKETIO_MESSAGE_QUEUE': message_queue,
+        'CHAT_ROOM_REGISTRY': 'sqlite:///' + os.path.join(directory, 'delivery_rooms.db'),
+        'SQLALCHEMY_DATABASE_URL': os.getenv('SQLALCHEMY_DATABASE_URL',
+                                             'sqlite:///' + os.path.join(directory, 'app.db')),
+        'SECRET_KEY': os.getenv('SECRET_KEY', 'benchmark'),
+        'ALGORITHM': os.getenv('ALGORITHM', 'HS256'),
+        'MAIL_TRANSPORT': 'memory',
+    }
+    registry = registry_from_url(environment['CHAT_ROOM_REGISTRY'])
+    registry.create(ROOM)
+
+    ports = [base_port + index for index in range(workers)]
+    servers = [multiprocessing.Process(target=chat_server, args=(port, environment), daemon=True) for port in ports]
+    for server in servers:
+        server.start()
+    try:
+        for port in ports:
+            wait_for_port(port)
+
+        received = [set() for _ in ports]
+        clients = []
+        for index, port in enumerate(ports):
+            client = socketio.Client()
+            client.on('messages', lambda batch, seen=received[index]: seen.update(
+                data['message'] for data in unpack(batch)))
+            cookie = session_cookie(environment['SECRET_KEY'], f'worker-{index}')
+            client.connect(f'http://127.0.0.1:{port}', headers={'Cookie': f'session={cookie}'})
+            clients.append(client)
+
+        members = registry.members(ROOM)
+        for index, client in enumerate(clients):
+            client.send({'data': f'hello from worker-{index}'})
+
+        expected = {f'hello from worker-{index}' for index in range(workers)}
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline and not all(expected <= seen for seen in received):
+            time.sleep(0.05)
+
+        for client in clients:
+            client.disconnect()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and registry.exists(ROOM):
+            time.sleep(0.05)
+        room_removed = not registry.exists(ROOM)
+    finally:
+        for server in servers:
+            server.terminate()
+
+    reports = [{'worker': index, 'missing': sorted(expected - seen)} for index, seen in enumerate(received)]
+    ok = members == workers and room_removed and not any(report['missing'] for report in reports)
+    return {'members': members, 'expected_members': workers, 'room_removed': room_removed, 'workers': reports,
+            'ok': ok}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--cycles', type=int, default=500)
+    parser.add_argument('--message-queue', default=os.getenv('SOCKETIO_MESSAGE_QUEUE'))
+    parser.add_argument('--port', type=int, default=5100, help='first port of the delivery check workers')
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        report = {'members': check_members(args.workers, args.cycles, directory)}
+        if args.message_queue:
+            report['delivery'] = check_delivery(args.workers, args.message_queue, directory, args.port)
+
+    print(json.dumps(report, indent=2))
+    return 0 if all(part['ok'] for part in report.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+Load test of the web app: HTTP routes and Socket.IO chat under concurrent simulated clients.
+
+The app is started in a child process against a fresh SQLite database and, by default, an
+in-memory Mongo (mongomock) instead of MONGO_DATABASE_URI. It is seeded with users and posts, then:
+
+1. HTTP: --clients threads request home, post, user_posts and login pages for --duration seconds.
+2. Socket.IO: --socket-clients users log in, enter the chat room and connect; each sends
+   --messages messages and waits for its own broadcast to come back; then all disconnect.
+
+Throughput and p50/p95/p99 latency per route and per event are written as JSON, together with the
+commit, so runs on different commits can be compared. Under the development server, a websocket
+disconnect waits out the client's close timeout (about 3 s), so compare it only between runs on the
+same server:
+
+    python benchmarks/load_test.py --clients 16 --duration 20 --output results/load.json
+    python benchmarks/load_test.py --mongo real   # uses MONGO_DATABASE_URI
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'load-test-password'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 2)
+
+
+def summarize(samples, elapsed):
+    report = {}
+    for name, (latencies, errors) in sorted(samples.items()):
+        latencies = sorted(latencies)
+        report[name] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'per_sec': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'p50_ms': percentile(latencies, 0.5),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+        }
+    return report
+
+
+class Recorder:
+    def __init__(self):
+        self._samples = defaultdict(lambda: ([], 0))
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, ok=True):
+        with self._lock:
+            latencies, errors = self._samples[name]
+            if ok:
+                latencies.append(seconds)
+            self._samples[name] = (latencies, errors + (0 if ok else 1))
+
+    def samples(self):
+        with self._lock:
+            return dict(self._samples)
+
+
+def serve(port, environment, users, posts, mongo):
+    """Child process: seeds the database and runs the app."""
+    os.environ.update(environment)
+    if mongo == 'mock':
+        import mongomock
+        import pymongo.mongo_client
+
+        pymongo.mongo_client.MongoClient = mongomock.MongoClient
+
+    import main
+    from database.sql_db.connect import engine, session_db
+    from database.sql_db.models import Base, User, Post
+    from system import password_hasher
+
+    def stop(*_):
+        # The server threads would keep a normal exit waiting; the hashing pool is stopped by hand so
+        # its processes do not outlive the server.
+        if password_hasher._pool is not None:
+            password_hasher._pool.shutdown(wait=True, cancel_futures=True)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    engine.echo = False
+    main.app.config['WTF_CSRF_ENABLED'] = False
+    Base.metadata.create_all(engine)
+    hashed = password_hasher.hash(PASSWORD)
+    accounts = [User(username=f'user{i}', email=f'user{i}@example.com', password=hashed, is_active=True)
+                for i in range(users)]
+    session_db.add_all(accounts)
+    session_db.flush()
+    for i in range(posts):
+        session_db.add(Post(title=f'Question {i} about tenancy law',
+                            content=f'Post {i}: can a landlord keep the deposit after the lease ends?',
+                            user_id=accounts[i % users].id))
+    session_db.commit()
+    session_db.remove()
+    main.socketio.run(main.app, host='127.0.0.1', port=port, allow_unsafe_werkzeug=True, log_output=False)
+
+
+def wait_for_port(port, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and server.is_alive():
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'app on port {port} did not start')
+
+
+def login(http, base, user):
+    return http.post(f'{base}/login', data={'email': f'user{user}@example.com', 'password': PASSWORD},
+                     allow_redirects=False)
+
+
+def http_client(base, args, recorder, stop, seed):
+    import requests
+
+    rng = random.Random(seed)
+    http = requests.Session()
+    pages = max(args.posts // 5, 1)
+    routes = [
+        ('home', lambda: http.get(f'{base}/home')),
+        ('home_page', lambda: http.get(f'{base}/home', params={'page': rng.randint(1, pages)})),
+        ('post', lambda: http.get(f'{base}/post/{rng.randint(1, args.posts)}')),
+        ('user_posts', lambda: http.get(f'{base}/user/user{rng.randrange(args.users)}')),
+        ('login', lambda: login(http, base, rng.randrange(args.users))),
+    ]
+    weights = [4, 3, 4, 3, 1]
+    while not stop.is_set():
+        name, request = rng.choices(routes, weights)[0]
+        started = time.perf_counter()
+        try:
+            response = request()
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        recorder.record(name, time.perf_counter() - started, ok)
+        if name == 'login':
+            http.cookies.clear()
+
+
+def run_http(base, args):
+    recorder, stop = Recorder(), threading.Event()
+    threads = [threading.Thread(target=http_client, args=(base, args, recorder, stop, index), daemon=True)
+               for index in range(args.clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return summarize(recorder.samples(), time.perf_counter() - started)
+
+
+def socket_client(base, index, args, recorder, barrier):
+    import requests
+    import socketio
+
+    http = requests.Session()
+    login(http, base, index % args.users)
+    # Posting the home page form puts the chat room and the user's name into the session.
+    http.post(f'{base}/home', data={'create': ''}, allow_redirects=False)
+    cookie = '; '.join(f'{name}={value}' for name, value in http.cookies.items())
+
+    pending = {}
+    client = socketio.Client()
+
+    @client.on('messages')
+    def on_messages(batch):
+        if isinstance(batch, bytes):
+            import msgpack
+
+            batch = msgpack.unpackb(batch)
+        for data in batch:
+            waiter = pending.get(data.get('message'))
+            if waiter is not None:
+                waiter.set()
+
+    barrier.wait()
+    started = time.perf_counter()
+    try:
+        client.connect(base, headers={'Cookie': cookie}, transports=['websocket'])
+        recorder.record('connect', time.perf_counter() - started)
+    except socketio.exceptions.ConnectionError:
+        recorder.record('connect', time.perf_counter() - started, ok=False)
+        barrier.wait()
+        return
+
+    for _ in range(args.messages):
+        text = uuid.uuid4().hex
+        pending[text] = threading.Event()
+        started = time.perf_counter()
+        client.send({'data': text})
+        ok = pending[text].wait(10)
+        recorder.record('message_round_trip', time.perf_counter() - started, ok)
+        del pending[text]
+
+    barrier.wait()
+    started = time.perf_counter()
+    client.disconnect()
+    recorder.record('disconnect', time.perf_counter() - started)
+
+
+def run_socketio(base, args):
+    recorder = Recorder()
+    barrier = threading.Barrier(args.socket_clients)
+    threads = [threading.Thread(target=socket_client, args=(base, index, args, recorder, barrier), daemon=True)
+               for index in range(args.socket_clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(recorder.samples(), time.perf_counter() - started)
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of HTTP load')
+    parser.add_argument('--socket-clients', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=20, help='chat messages per Socket.IO client')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--mongo', choices=['mock', 'real'], default='mock')
+    parser.add_argument('--bcrypt-rounds', type=int, default=int(os.getenv('BCRYPT_LOG_ROUNDS', 12)))
+    parser.add_argument('--port', type=int, default=5200)
+    parser.add_argument('--output', help='JSON file to write (default: stdout only)')
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        environment = {
+            'SQLALCHEMY_DATABASE_URL': 'sqlite:///' + os.path.join(directory, 'load.db'),
+            'SECRET_KEY': os.getenv('SECRET_KEY', 'load-test'),
+            'ALGORITHM': os.getenv('ALGORITHM', 'HS256'),
+            'MAIL_TRANSPORT': 'memory',
+            'BCRYPT_LOG_ROUNDS': str(args.bcrypt_rounds),
+        }
+        server = multiprocessing.Process(target=serve, args=(args.port, environment, args.users, args.posts,
+                                                             args.mongo))
+        server.start()
+        try:
+            wait_for_port(args.port, server)
+            base = f'http://127.0.0.1:{args.port}'
+            report = {
+                'commit': commit(),
+                'started_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'settings': vars(args),
+                'http': run_http(base, args),
+                'socketio': run_socketio(base, args) if args.socket_clients else {},
+            }
+        finally:
+            server.terminate()
+            server.join(30)
+            if server.is_alive():
+                server.kill()
+                server.join()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Counts the SQL statements each listing page runs and fails if a page runs more than expected.
+
+Posts are spread over several authors so a lazily loaded Post.user would show up as one extra
+SELECT per post. The page cache is invalidated before every request and every page is requested
+once beforehand, so the counts cover rendering with warm counters:
+
+    python benchmarks/query_counts.py
+"""
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+EXPECTED = {
+    '/home': 1,
+    '/home?page=3': 1,
+    '/user/author0': 2,
+    '/user/author0?page=2': 2,
+    '/post/1': 1,
+    '/search?q=statute': 1,
+}
+
+
+def seed(session, User, Post, authors=5, posts_per_author=12):
+    users = [User(username=f'author{i}', email=f'author{i}@example.com', password='x', is_active=True)
+             for i in range(authors)]
+    session.add_all(users)
+    session.flush()
+    started = datetime(2024, 1, 1)
+    for i in range(authors * posts_per_author):
+        session.add(Post(title=f'Post {i}', content=f'statute number {i}', user_id=users[i % authors].id,
+                         date_posted=started + timedelta(minutes=i)))
+    session.commit()
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'sqlite:///' + os.path.join(directory, 'queries.db'))
+    os.environ.setdefault('SECRET_KEY', 'query-counts')
+    os.environ.setdefault('MAIL_TRANSPORT', 'memory')
+
+    from sqlalchemy import event
+
+    from main import app, page_cache
+    from database.sql_db.connect import engine, session_db
+    from database.sql_db.models import Base, User, Post
+
+    engine.echo = False
+    Base.metadata.create_all(engine)
+    seed(session_db, User, Post)
+    session_db.remove()
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    client = app.test_client()
+    report, failed = {}, False
+    for url, expected in EXPECTED.items():
+        page_cache.invalidate()
+        client.get(url)
+        page_cache.invalidate()
+        statements.clear()
+        response = client.get(url)
+        count = len(statements)
+        report[url] = {'status': response.status_code, 'statements': count, 'expected': expected}
+        if response.status_code != 200 or count != expected:
+            failed = True
+            report[url]['sql'] = list(statements)
+
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
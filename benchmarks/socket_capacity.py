@@ -0,0 +1,245 @@
+"""
+How many idle chat sockets one server process holds, what they cost in memory, and whether HTTP
+requests stay fast meanwhile: the development server (threading, as `python main.py` runs it)
+against serve.py under gevent.
+
+For every worker model the app is started in a child process against a throwaway SQLite database
+and, by default, an in-memory Mongo (mongomock). Socket.IO connections are then opened up to each
+of --levels and kept idle (their pings are answered). At every level the report has the connect
+latency, the server's RSS and its growth per socket, and the latency of GET /home:
+
+    python benchmarks/socket_capacity.py --workers threading gevent --levels 250 1000 2000
+"""
+import argparse
+import json
+import os
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child as `python -c`, so the monkey-patching happens before anything else is imported.
+SERVER = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+worker, port, mongo = sys.argv[2], int(sys.argv[3]), sys.argv[4]
+import serve
+if worker != 'threading':
+    serve.patch(worker)
+if mongo == 'mock':
+    import mongomock
+    import pymongo.mongo_client
+    pymongo.mongo_client.MongoClient = mongomock.MongoClient
+from main import app, socketio
+from database.sql_db.connect import engine
+from database.sql_db.models import Base
+Base.metadata.create_all(engine)
+if worker == 'threading':
+    socketio.run(app, host='127.0.0.1', port=port, allow_unsafe_werkzeug=True)
+else:
+    serve.run('127.0.0.1', port)
+'''
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 2)
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'app on port {port} did not start')
+
+
+class IdleSockets:
+    """Socket.IO connections over raw websockets, kept open by one thread that answers the server's pings."""
+
+    def __init__(self, port):
+        self.url = f'ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket'
+        self.connections = []
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._keepalive, daemon=True)
+        self._thread.start()
+
+    def open(self):
+        """Opens one connection and joins the default namespace; returns the seconds it took."""
+        import websocket
+
+        started = time.perf_counter()
+        connection = websocket.create_connection(self.url, timeout=30)
+        connection.recv()  # engine.io open packet
+        connection.send('40')
+        while not connection.recv().startswith('40'):
+            pass
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.connections.append(connection)
+            self._selector.register(connection.sock, selectors.EVENT_READ, connection)
+        return elapsed
+
+    def _keepalive(self):
+        while not self._stop.is_set():
+            with self._lock:
+                ready = self._selector.select(timeout=0) if self.connections else []
+            for key, _ in ready:
+                try:
+                    if key.data.recv() == '2':
+                        key.data.send('3')
+                except Exception:
+                    with self._lock:
+                        self._selector.unregister(key.fileobj)
+            time.sleep(0.05)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        for connection in self.connections:
+            try:
+                connection.close(timeout=0)
+            except Exception:
+                pass
+
+
+def probe_http(port, count):
+    import requests
+
+    latencies, errors = [], 0
+    with requests.Session() as http:
+        for _ in range(count):
+            started = time.perf_counter()
+            try:
+                ok = http.get(f'http://127.0.0.1:{port}/home', timeout=30).status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+    return latencies, errors
+
+
+def measure(worker, args, directory):
+    environment = dict(os.environ,
+                       SQLALCHEMY_DATABASE_URL='sqlite:///' + os.path.join(directory, f'{worker}.db'),
+                       SECRET_KEY=os.getenv('SECRET_KEY', 'socket-capacity'),
+                       ALGORITHM=os.getenv('ALGORITHM', 'HS256'),
+                       MAIL_TRANSPORT='memory')
+    server = subprocess.Popen([sys.executable, '-c', SERVER, ROOT, worker, str(args.port), args.mongo],
+                              env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sockets = None
+    try:
+        wait_for_port(args.port, server)
+        probe_http(args.port, 5)
+        baseline = rss_bytes(server.pid)
+        sockets = IdleSockets(args.port)
+        results = []
+        for level in args.levels:
+            latencies, failed = [], 0
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                for outcome in pool.map(lambda _: _try(sockets.open), range(level - len(sockets.connections))):
+                    if outcome is None:
+                        failed += 1
+                    else:
+                        latencies.append(outcome)
+            time.sleep(1)
+            rss = rss_bytes(server.pid)
+            http_latencies, http_errors = probe_http(args.port, args.probes)
+            connected = len(sockets.connections)
+            results.append({
+                'target': level,
+                'connected': connected,
+                'failed': failed,
+                'connect_p50_ms': percentile(latencies, 0.5),
+                'connect_p95_ms': percentile(latencies, 0.95),
+                'rss_mb': round(rss / 2 ** 20, 1) if rss else None,
+                'rss_per_socket_kb': round((rss - baseline) / connected / 1024, 1) if rss and connected else None,
+                'http_p50_ms': percentile(http_latencies, 0.5),
+                'http_p95_ms': percentile(http_latencies, 0.95),
+                'http_errors': http_errors,
+                'server_alive': server.poll() is None,
+            })
+            if server.poll() is not None or failed == level:
+                break
+        return {'baseline_rss_mb': round(baseline / 2 ** 20, 1) if baseline else None, 'levels': results}
+    finally:
+        if sockets is not None:
+            sockets.close()
+        server.terminate()
+        try:
+            server.wait(30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+
+def _try(function):
+    try:
+        return function()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', nargs='+', choices=['threading', 'gevent', 'eventlet'],
+                        default=['threading', 'gevent'])
+    parser.add_argument('--levels', nargs='+', type=int, default=[100, 500, 1000, 2000],
+                        help='total idle sockets to reach, in increasing order')
+    parser.add_argument('--concurrency', type=int, default=32, help='connections opened in parallel')
+    parser.add_argument('--probes', type=int, default=50, help='GET /home requests at each level')
+    parser.add_argument('--mongo', choices=['mock', 'real'], default='mock')
+    parser.add_argument('--port', type=int, default=5300)
+    parser.add_argument('--output', help='JSON file to write (default: stdout only)')
+    args = parser.parse_args()
+
+    # Both processes need a descriptor per socket; the server inherits the raised limit.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = {'settings': vars(args), 'open_files_limit': hard,
+                  'results': {worker: measure(worker, args, directory) for worker in args.workers}}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Import time and memory of a freshly started worker, for the web-only and the inference role.
+
+Every run starts a new interpreter that imports system.py and then main.py, and reports the time
+each import took, the resident set size afterwards, and which heavy ML libraries ended up in
+sys.modules. The web role must not import any of them; the inference role preloads the models
+named by --preload, as a pre-fork master would.
+
+    python benchmarks/startup.py --runs 5
+    python benchmarks/startup.py --roles web inference --model sshleifer/tiny-gpt2 --preload generator
+
+Without SQLALCHEMY_DATABASE_URL in the environment the app runs against a throwaway SQLite file.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('torch', 'transformers', 'spacy', 'gensim', 'nltk', 'langchain')
+
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import system
+system_seconds = time.perf_counter() - started
+started = time.perf_counter()
+import main
+main_seconds = time.perf_counter() - started
+rss_kb = None
+try:
+    with open('/proc/self/status') as f:
+        rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+except OSError:
+    import resource
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'system_seconds': system_seconds,
+    'main_seconds': main_seconds,
+    'rss_mb': rss_kb / 1024,
+    'heavy_modules': sorted(name for name in %r if name in sys.modules),
+    'models': main.models.stats(),
+}))
+''' % (HEAVY_MODULES,)
+
+
+def run_once(env):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if result.returncode:
+        raise SystemExit(result.stderr)
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['process_seconds'] = wall
+    return report
+
+
+def role_env(role, args, directory):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    env.setdefault('SQLALCHEMY_DATABASE_URL', 'sqlite:///' + os.path.join(directory, 'startup.db'))
+    env.setdefault('SECRET_KEY', 'startup-benchmark')
+    env.setdefault('MAIL_TRANSPORT', 'memory')
+    env.pop('PRELOAD_MODELS', None)
+    if role == 'inference':
+        if args.model:
+            env['INFERENCE_MODEL'] = args.model
+        env['PRELOAD_MODELS'] = ','.join(args.preload)
+    return env
+
+
+def summarize(runs):
+    def median(key):
+        return round(statistics.median(run[key] for run in runs), 3)
+
+    return {
+        'runs': len(runs),
+        'process_seconds': median('process_seconds'),
+        'system_import_seconds': median('system_seconds'),
+        'main_import_seconds': median('main_seconds'),
+        'rss_mb': round(statistics.median(run['rss_mb'] for run in runs), 1),
+        'heavy_modules': runs[-1]['heavy_modules'],
+        'model_load_seconds': runs[-1]['models']['load_seconds'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--roles', nargs='+', choices=['web', 'inference'], default=['web'])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--model', default=os.getenv('INFERENCE_MODEL'), help='INFERENCE_MODEL for the inference role')
+    parser.add_argument('--preload', nargs='+', default=['generator'],
+                        help='models the inference role loads before it would fork')
+    args = parser.parse_args()
+
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for role in args.roles:
+            env = role_env(role, args, directory)
+            report[role] = summarize([run_once(env) for _ in range(args.runs)])
+
+    if 'web' in report and report['web']['heavy_modules']:
+        report['web']['error'] = 'the web role imported heavy ML libraries'
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
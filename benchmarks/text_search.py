@@ -0,0 +1,72 @@
+"""
+Query latency of the BM25 index (text_search.BM25Index) on a synthetic corpus, for rare terms and
+for terms common enough to appear in most documents, plus indexing and replacement throughput.
+
+Word frequencies follow Zipf's law, as in real text, so the most frequent words have postings
+lists covering nearly the whole corpus, which is the worst case for a query.
+
+    python benchmarks/text_search.py --docs 100000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from text_search import BM25Index  # noqa: E402
+
+QUERIES = {
+    'rare': 'w2500',
+    'medium': 'w120 w340',
+    'common': 'w1',
+    'common_3_terms': 'w1 w2 w3',
+}
+
+
+def document(rng, vocabulary):
+    return ' '.join(f'w{min(int(rng.paretovariate(1.0)), vocabulary - 1)}' for _ in range(rng.randint(20, 150)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=100000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=50, help='runs of every query')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [document(rng, args.vocabulary) for _ in range(args.docs)]
+    index = BM25Index()
+    started = time.perf_counter()
+    for key, text in enumerate(texts):
+        index.add(key, text)
+    add_seconds = time.perf_counter() - started
+
+    report = {'settings': vars(args), 'add_docs_per_sec': round(args.docs / add_seconds, 1), 'queries': {}}
+    for name, query in QUERIES.items():
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            matches, _ = index.search(query, limit=10)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        report['queries'][name] = {'query': query, 'matches': matches,
+                                   'p50_ms': round(timings[len(timings) // 2] * 1000, 2),
+                                   'max_ms': round(timings[-1] * 1000, 2)}
+
+    # Replacing documents (edited posts) leaves deleted numbers behind until compaction.
+    replaced = args.docs // 2
+    started = time.perf_counter()
+    for key in range(replaced):
+        index.add(key, texts[-1 - key])
+    report['replace_docs_per_sec'] = round(replaced / (time.perf_counter() - started), 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
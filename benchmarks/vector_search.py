@@ -0,0 +1,91 @@
+"""
+Queries/sec of the vector index, brute force against IVF, and IVF recall@k against brute force.
+
+Uses synthetic clustered embeddings so it runs without a model or a database:
+    python benchmarks/vector_search.py --rows 200000 --dim 384 --lists 512 --nprobe 8 16 32
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ai.vector_index import VectorIndex, normalize_rows  # noqa: E402
+
+
+def synthetic(rows, centers, spread, rng):
+    """`rows` unit vectors scattered around randomly chosen `centers`, `spread` times their scale."""
+    dim = centers.shape[1]
+    labels = rng.integers(0, len(centers), size=rows)
+    return normalize_rows(centers[labels] + spread * rng.standard_normal((rows, dim)).astype(np.float32))
+
+
+def timed_search(index, queries, k, batch, nprobe=None):
+    started = time.perf_counter()
+    results = [index.search(queries[start:start + batch], k=k, nprobe=nprobe)[0]
+               for start in range(0, len(queries), batch)]
+    elapsed = time.perf_counter() - started
+    return np.concatenate(results), round(len(queries) / elapsed, 1)
+
+
+def recall(found, truth):
+    hits = sum(len(set(row) & set(expected)) for row, expected in zip(found, truth))
+    return round(hits / truth.size, 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=32, help='queries per search call')
+    parser.add_argument('--lists', type=int, default=256)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--spread', type=float, default=2.0,
+                        help='noise around the cluster centers; higher makes clusters overlap and IVF recall drop')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    # Queries come from the same clusters as the corpus, as questions come from the topics of the documents.
+    centers = rng.standard_normal((args.lists * 2, args.dim)).astype(np.float32)
+    vectors = synthetic(args.rows, centers, args.spread, rng)
+    queries = synthetic(args.queries, centers, args.spread, rng)
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = VectorIndex(directory, dim=args.dim)
+        started = time.perf_counter()
+        for start in range(0, args.rows, 10000):
+            index.append([str(row) for row in range(start, min(start + 10000, args.rows))],
+                         vectors[start:start + 10000])
+        append_seconds = time.perf_counter() - started
+
+        truth, brute_qps = timed_search(index, queries, args.k, args.batch)
+        started = time.perf_counter()
+        index.build_ivf(lists=args.lists)
+        ivf_seconds = time.perf_counter() - started
+
+        report = {
+            'rows': args.rows, 'dim': args.dim, 'queries': args.queries, 'k': args.k, 'batch': args.batch,
+            'append_rows_per_sec': round(args.rows / append_seconds, 1),
+            'ivf_build_seconds': round(ivf_seconds, 3),
+            'brute_force': {'qps': brute_qps, 'recall': 1.0},
+            'ivf': [],
+        }
+        for nprobe in args.nprobe:
+            found, qps = timed_search(index, queries, args.k, args.batch, nprobe=nprobe)
+            report['ivf'].append({'nprobe': nprobe, 'qps': qps, 'recall': recall(found, truth)})
+        del index
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
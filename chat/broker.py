@@ -0,0 +1,69 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from socketio import PubSubManager
+
+
+class SQLiteManager(PubSubManager):
+    """
+    Socket.IO client manager that fans broadcasts out to every worker process on the host through
+    a shared SQLite file, for deployments without Redis. Each worker appends published messages to
+    a table and polls it for rows written after the ones it has already seen. Messages are stored
+    pickled, so emits with binary payloads (msgpack chat batches) cross workers as they are.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, channel='socketio', write_only=False, logger=None, poll_interval=0.02,
+                 retention=60.0):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS socketio_messages ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, '
+                           'payload BLOB NOT NULL, created REAL NOT NULL)')
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _publish(self, data):
+        self._connection().execute('INSERT INTO socketio_messages (channel, payload, created) VALUES (?, ?, ?)',
+                                   (self.channel, pickle.dumps(data), time.time()))
+
+    def _listen(self):
+        connection = self._connection()
+        last_id = connection.execute('SELECT COALESCE(MAX(id), 0) FROM socketio_messages').fetchone()[0]
+        last_purge = time.monotonic()
+        while True:
+            rows = connection.execute('SELECT id, payload FROM socketio_messages WHERE id > ? AND channel = ? '
+                                      'ORDER BY id', (last_id, self.channel)).fetchall()
+            for row_id, payload in rows:
+                last_id = row_id
+                yield pickle.loads(payload)
+            if time.monotonic() - last_purge > self.retention:
+                connection.execute('DELETE FROM socketio_messages WHERE created < ?', (time.time() - self.retention,))
+                last_purge = time.monotonic()
+            if not rows:
+                self.server.sleep(self.poll_interval)
+
+
+def queue_options(url):
+    """
+    SocketIO() keyword arguments for SOCKETIO_MESSAGE_QUEUE: 'sqlite:///path/to/queue.db' uses
+    SQLiteManager, any other URL (redis://, amqp://, kafka://) is handed to Flask-SocketIO as is.
+    """
+    if not url:
+        return {}
+    if url.startswith('sqlite:///'):
+        return {'client_manager': SQLiteManager(url[len('sqlite:///'):])}
+    return {'message_queue': url}
@@ -0,0 +1,236 @@
+import atexit
+import os
+import threading
+import time
+from collections import deque
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+
+class RoomBuffer:
+    def __init__(self, capacity, next_seq=0):
+        self.messages = deque(maxlen=capacity)
+        self.next_seq = next_seq
+        # Every message with a lower seq is already stored in Mongo.
+        self.persisted_upto = next_seq
+
+
+class ChatHistory:
+    """
+    Chat history per room. The last `capacity` messages of every room are kept in a ring buffer;
+    messages pushed out of it are collected and written to Mongo in bulk by a background thread,
+    so memory per room stays bounded while the full history remains available.
+
+    With several worker processes (`shared`) a buffer would only hold the messages its own worker
+    received, so every message is written to Mongo as it arrives and history is read from there;
+    `sequence` (a shared room registry's next_seq) keeps sequence numbers unique across workers.
+    """
+
+    def __init__(self, collection, capacity=200, batch_size=100, flush_interval=2.0, sequence=None, shared=False):
+        self.collection = collection
+        self.sequence = sequence
+        self.shared = shared
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._rooms = {}
+        # Shared mode: the highest stored seq of each room, the floor for the registry's numbers.
+        self._floors = {}
+        self._spill = []
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._flusher = None
+        self._pid = None
+        self._indexed = False
+
+        atexit.register(self.close)
+
+    def _ensure_flusher(self):
+        if self._pid == os.getpid():
+            return
+        self._flusher = threading.Thread(target=self._run, name='chat-history-flusher', daemon=True)
+        self._flusher.start()
+        self._pid = os.getpid()
+
+    def _buffer(self, room):
+        """
+        Returns the room's buffer, seeding a new one with the latest stored messages. The Mongo query
+        runs outside the lock so a slow database does not stall other rooms.
+        """
+        with self._lock:
+            buffer = self._rooms.get(room)
+        if buffer is not None:
+            return buffer
+        try:
+            stored = list(self.collection.find({'room': room}, {'_id': 0, 'room': 0})
+                          .sort('seq', DESCENDING).limit(self.capacity))
+        except PyMongoError:
+            stored = []
+        with self._lock:
+            if room in self._rooms:
+                return self._rooms[room]
+            # A closed room may still have messages waiting in the spill.
+            pending = [doc['seq'] for doc in self._spill if doc['room'] == room]
+            next_seq = max([stored[0]['seq'] if stored else -1] + pending) + 1
+            buffer = RoomBuffer(self.capacity, next_seq)
+            buffer.messages.extend(reversed(stored))
+            self._rooms[room] = buffer
+            return buffer
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index([('room', ASCENDING), ('seq', DESCENDING)], unique=True)
+            self._indexed = True
+
+    def _spill_message(self, room, content):
+        """Queues a message for the flusher; call with the lock held."""
+        self._ensure_flusher()
+        self._spill.append(dict(content, room=room))
+        if len(self._spill) >= self.batch_size:
+            self._wake.set()
+
+    def append(self, room, name, message):
+        """Stores a message and returns it as it should be broadcast to the room."""
+        if self.shared:
+            return self._append_shared(room, name, message)
+        buffer = self._buffer(room)
+        # The shared sequence may wait on another process, so it is allocated before taking the lock.
+        seq = self.sequence(room, buffer.next_seq) if self.sequence else None
+        with self._lock:
+            buffer = self._rooms.setdefault(room, buffer)
+            self._ensure_flusher()
+            if seq is None:
+                seq = buffer.next_seq
+            content = {'seq': seq, 'name': name, 'message': message, 'ts': time.time()}
+            buffer.next_seq = max(buffer.next_seq, seq + 1)
+            messages = buffer.messages
+            # A message numbered earlier by another thread may arrive later; the buffer stays in seq order.
+            position = len(messages)
+            while position and messages[position - 1]['seq'] > seq:
+                position -= 1
+            if len(messages) == messages.maxlen:
+                if position == 0:
+                    self._spill_message(room, content)
+                    return content
+                evicted = messages.popleft()
+                position -= 1
+                if evicted['seq'] >= buffer.persisted_upto:
+                    self._spill_message(room, evicted)
+            messages.insert(position, content)
+        return content
+
+    def _floor(self, room, refresh=False):
+        with self._lock:
+            floor = None if refresh else self._floors.get(room)
+        if floor is None:
+            try:
+                latest = self.collection.find_one({'room': room}, {'seq': 1}, sort=[('seq', DESCENDING)])
+            except PyMongoError:
+                latest = None
+            floor = latest['seq'] + 1 if latest else 0
+            with self._lock:
+                self._floors[room] = floor
+        return floor
+
+    def _append_shared(self, room, name, message):
+        content = {'name': name, 'message': message, 'ts': time.time()}
+        for refresh in (False, True):
+            seq = self.sequence(room, self._floor(room, refresh)) if self.sequence else self._floor(room, True)
+            content = dict(content, seq=seq)
+            try:
+                self._ensure_index()
+                self.collection.insert_one(dict(content, room=room))
+                return content
+            except DuplicateKeyError:
+                # The registry's counter is behind what is stored, e.g. after it was reset.
+                continue
+            except PyMongoError:
+                break
+        with self._lock:
+            self._spill_message(room, content)
+        return content
+
+    def recent(self, room, limit=50):
+        if self.shared:
+            return self.before(room, None, limit)[0]
+        buffer = self._buffer(room)
+        with self._lock:
+            return list(buffer.messages)[-limit:]
+
+    def before(self, room, before_seq, limit=50):
+        """
+        Returns up to `limit` messages older than `before_seq` (None for the latest), oldest first, and
+        whether there are more. Served from the ring buffer and the unwritten spill first, then from Mongo.
+        """
+        found = {}
+        buffer = None if self.shared else self._buffer(room)
+        with self._lock:
+            if buffer is not None:
+                if before_seq is None:
+                    before_seq = buffer.next_seq
+                found = {m['seq']: m for m in buffer.messages if m['seq'] < before_seq}
+            for doc in self._spill:
+                if doc['room'] == room and (before_seq is None or doc['seq'] < before_seq):
+                    found[doc['seq']] = {k: v for k, v in doc.items() if k != 'room'}
+
+        if len(found) <= limit:
+            lowest = min(found, default=before_seq)
+            query = {'room': room}
+            if lowest is not None:
+                query['seq'] = {'$lt': lowest}
+            try:
+                stored = self.collection.find(query, {'_id': 0, 'room': 0}) \
+                    .sort('seq', DESCENDING).limit(limit + 1 - len(found))
+                for doc in stored:
+                    found.setdefault(doc['seq'], doc)
+            except PyMongoError:
+                pass
+
+        seqs = sorted(found)
+        has_more = len(seqs) > limit
+        return [found[seq] for seq in seqs[-limit:]], has_more
+
+    def close_room(self, room):
+        """Drops the room's buffer, queueing whatever is not yet in Mongo for the next flush."""
+        with self._lock:
+            self._floors.pop(room, None)
+            buffer = self._rooms.pop(room, None)
+            if buffer is None:
+                return
+            self._spill.extend(dict(m, room=room) for m in buffer.messages if m['seq'] >= buffer.persisted_upto)
+        self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            batch = self._spill[:self.batch_size * 10]
+        if not batch:
+            return 0
+        try:
+            self._ensure_index()
+            # insert_many mutates its documents, so it gets copies.
+            self.collection.insert_many([dict(doc) for doc in batch], ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys mean a retried batch was already partly written.
+            if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                return 0
+        except PyMongoError:
+            return 0
+        with self._lock:
+            del self._spill[:len(batch)]
+        return len(batch)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            while self.flush() >= self.batch_size * 10:
+                pass
+
+    def close(self):
+        with self._lock:
+            for room in list(self._rooms):
+                self.close_room(room)
+        while self.flush():
+            pass
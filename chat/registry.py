@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class MemoryRoomRegistry:
+    """Room membership kept in this process. Only correct with a single worker process."""
+
+    def __init__(self):
+        self._members = {}
+        self._seq = {}
+        self._lock = threading.Lock()
+
+    def create(self, room):
+        with self._lock:
+            self._members.setdefault(room, 0)
+
+    def exists(self, room):
+        with self._lock:
+            return room in self._members
+
+    def join(self, room):
+        """Adds a member and returns the new count, or None if the room does not exist."""
+        with self._lock:
+            if room not in self._members:
+                return None
+            self._members[room] += 1
+            return self._members[room]
+
+    def leave(self, room):
+        """Removes a member and returns how many are left, deleting the room at zero. None if it did not exist."""
+        with self._lock:
+            if room not in self._members:
+                return None
+            self._members[room] -= 1
+            if self._members[room] <= 0:
+                del self._members[room]
+                return 0
+            return self._members[room]
+
+    def members(self, room):
+        with self._lock:
+            return self._members.get(room, 0)
+
+    def next_seq(self, room, floor=0):
+        """Allocates the next chat message sequence number of a room, never lower than `floor`."""
+        with self._lock:
+            seq = max(self._seq.get(room, -1) + 1, floor)
+            self._seq[room] = seq
+            return seq
+
+
+class SQLiteRoomRegistry:
+    """
+    Room membership in a SQLite file shared by every worker process on the host. Each operation
+    runs in its own IMMEDIATE transaction, so concurrent joins and leaves from different processes
+    are serialized by the database lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS rooms (code TEXT PRIMARY KEY, members INTEGER NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS room_seq (code TEXT PRIMARY KEY, seq INTEGER NOT NULL)')
+
+    def _connection(self):
+        # sqlite3 connections must not cross threads or fork().
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def create(self, room):
+        with self._transaction() as connection:
+            connection.execute('INSERT OR IGNORE INTO rooms (code, members) VALUES (?, 0)', (room,))
+
+    def exists(self, room):
+        row = self._connection().execute('SELECT 1 FROM rooms WHERE code = ?', (room,)).fetchone()
+        return row is not None
+
+    def join(self, room):
+        with self._transaction() as connection:
+            cursor = connection.execute('UPDATE rooms SET members = members + 1 WHERE code = ?', (room,))
+            if cursor.rowcount == 0:
+                return None
+            return connection.execute('SELECT members FROM rooms WHERE code = ?', (room,)).fetchone()[0]
+
+    def leave(self, room):
+        with self._transaction() as connection:
+            cursor = connection.execute('UPDATE rooms SET members = members - 1 WHERE code = ?', (room,))
+            if cursor.rowcount == 0:
+                return None
+            members = connection.execute('SELECT members FROM rooms WHERE code = ?', (room,)).fetchone()[0]
+            if members <= 0:
+                connection.execute('DELETE FROM rooms WHERE code = ?', (room,))
+                return 0
+            return members
+
+    def members(self, room):
+        row = self._connection().execute('SELECT members FROM rooms WHERE code = ?', (room,)).fetchone()
+        return row[0] if row else 0
+
+    def next_seq(self, room, floor=0):
+        with self._transaction() as connection:
+            row = connection.execute('SELECT seq FROM room_seq WHERE code = ?', (room,)).fetchone()
+            seq = max(row[0] + 1 if row else 0, floor)
+            connection.execute('INSERT OR REPLACE INTO room_seq (code, seq) VALUES (?, ?)', (room, seq))
+            return seq
+
+
+def registry_from_url(url):
+    """
+    Builds a room registry from CHAT_ROOM_REGISTRY: 'memory://' (the default) or 'sqlite:///path/to/rooms.db'.
+    """
+    if not url or url == 'memory://':
+        return MemoryRoomRegistry()
+    if url.startswith('sqlite:///'):
+        return SQLiteRoomRegistry(url[len('sqlite:///'):])
+    raise ValueError(f'Unsupported room registry: {url}')
@@ -0,0 +1,57 @@
+"""
+Keeps CPU-bound work off the event loop when the app runs under gevent or eventlet (see serve.py).
+
+Once the standard library is monkey-patched, the threads the app starts are green threads sharing
+one OS thread, and socket I/O (pymongo, SMTP, psycopg2 with psycogreen) yields to the others. Work
+that holds the CPU in C code, like model forward passes and embeddings, would still stall every
+request and socket of the process, so it goes through offload(), which runs it in the hub's pool
+of native threads. Without monkey-patching, offload() just calls the function.
+
+Only pure computation belongs in offload(): the patched locks, queues and sockets the app creates
+belong to the event loop and must not be used from the native threads.
+"""
+import sys
+
+_DONE = object()
+
+
+def green_mode():
+    """'gevent' or 'eventlet' when that library has patched the socket module, else None."""
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+
+        if monkey.is_module_patched('socket'):
+            return 'gevent'
+    if 'eventlet' in sys.modules:
+        from eventlet import patcher
+
+        if patcher.is_monkey_patched('socket'):
+            return 'eventlet'
+    return None
+
+
+def offload(function, *args, **kwargs):
+    """Calls function(*args, **kwargs) in a native thread; the calling green thread waits without blocking the others."""
+    mode = green_mode()
+    if mode == 'gevent':
+        import gevent
+
+        return gevent.get_hub().threadpool.apply(function, args, kwargs)
+    if mode == 'eventlet':
+        from eventlet import tpool
+
+        return tpool.execute(function, *args, **kwargs)
+    return function(*args, **kwargs)
+
+
+def iterate(iterable):
+    """Yields the items of `iterable`, computing each one in a native thread through offload()."""
+    if green_mode() is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        item = offload(next, iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
@@ -11,3 +11,5 @@ MONGO_DATABASE_URI = os.getenv('MONGO_DATABASE_URI')
 client = MongoClient(MONGO_DATABASE_URI, server_api=ServerApi('1'))
 db = client.lawyer_database
 mongo_collection = db.documents_collection
+chat_collection = db.chat_messages
+answer_cache_collection = db.answer_cache
@@ -0,0 +1,232 @@
+"""
+NDJSON export and import of posts, one JSON object per line:
+
+    {"id": 1, "title": "...", "content": "...", "date_posted": "2024-01-01T12:00:00", "author": "bob"}
+
+export_posts() streams the posts in id order through a server-side cursor (yield_per), so memory
+stays flat however many posts there are. import_posts() parses lines as they arrive and inserts
+each batch with one executemany INSERT in its own transaction; ids in the input are not kept.
+The inserts bypass the ORM, so the batch also adds to users.post_count what the Post insert
+event would have.
+
+    python -m database.sql_db.bulk export > posts.ndjson
+    python -m database.sql_db.bulk import posts.ndjson --batch-size 2000
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, insert, select, update
+
+from database.sql_db.models import User, Post
+
+posts_table = Post.__table__
+users_table = User.__table__
+TITLE_LENGTH = posts_table.c.title.type.length
+CONTENT_LENGTH = posts_table.c.description.type.length
+
+
+class TransferStats:
+    """Totals and the rate of the last run of each direction, for the /metrics endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.imported = 0
+        self.import_errors = 0
+        self.export_rows_per_sec = 0.0
+        self.import_rows_per_sec = 0.0
+
+    def record(self, direction, rows, seconds, errors=0):
+        with self._lock:
+            rate = round(rows / seconds, 1) if seconds else 0.0
+            if direction == 'export':
+                self.exported += rows
+                self.export_rows_per_sec = rate
+            else:
+                self.imported += rows
+                self.import_errors += errors
+                self.import_rows_per_sec = rate
+
+    def stats(self):
+        with self._lock:
+            return {
+                'exported': self.exported,
+                'imported': self.imported,
+                'import_errors': self.import_errors,
+                'export_rows_per_sec': self.export_rows_per_sec,
+                'import_rows_per_sec': self.import_rows_per_sec,
+            }
+
+
+transfer_stats = TransferStats()
+
+
+def export_posts(engine, batch_size=1000, user_id=None, report=None):
+    """
+    Yields the posts as NDJSON lines, fetching `batch_size` rows at a time.
+    :param user_id: Only export this author's posts.
+    :param report: Called with {'rows', 'seconds', 'rows_per_sec'} once the export ends.
+    """
+    query = select(posts_table.c.id, posts_table.c.title, posts_table.c.description, posts_table.c.created_at,
+                   users_table.c.username) \
+        .select_from(posts_table.outerjoin(users_table, posts_table.c.user_id == users_table.c.id)) \
+        .order_by(posts_table.c.id)
+    if user_id is not None:
+        query = query.where(posts_table.c.user_id == user_id)
+
+    started, rows = time.perf_counter(), 0
+    try:
+        with engine.connect() as connection:
+            result = connection.execution_options(yield_per=batch_size).execute(query)
+            for post_id, title, content, date_posted, author in result:
+                rows += 1
+                yield json.dumps({'id': post_id, 'title': title, 'content': content,
+                                  'date_posted': date_posted.isoformat() if date_posted else None,
+                                  'author': author}, ensure_ascii=False) + '\n'
+    finally:
+        seconds = time.perf_counter() - started
+        transfer_stats.record('export', rows, seconds)
+        if report is not None:
+            report({'rows': rows, 'seconds': round(seconds, 3),
+                    'rows_per_sec': round(rows / seconds, 1) if seconds else 0.0})
+
+
+def parse_post(line):
+    """Turns one NDJSON line into (row for the posts table, author username); raises ValueError if invalid."""
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError('expected a JSON object')
+    title, content = record.get('title'), record.get('content')
+    if not isinstance(title, str) or not title.strip() or len(title) > TITLE_LENGTH:
+        raise ValueError(f'title must be a non-empty string of at most {TITLE_LENGTH} characters')
+    if not isinstance(content, str) or not content.strip() or len(content) > CONTENT_LENGTH:
+        raise ValueError(f'content must be a non-empty string of at most {CONTENT_LENGTH} characters')
+    date_posted = record.get('date_posted')
+    if date_posted:
+        date_posted = datetime.fromisoformat(date_posted)
+        if date_posted.tzinfo is not None:
+            date_posted = date_posted.astimezone(timezone.utc).replace(tzinfo=None)
+    else:
+        date_posted = datetime.now(timezone.utc).replace(tzinfo=None)
+    return {'title': title, 'description': content, 'created_at': date_posted}, record.get('author')
+
+
+def import_posts(engine, lines, batch_size=1000, user_id=None, max_error_samples=20, on_batch=None):
+    """
+    Inserts the posts read from `lines` (an iterable of NDJSON lines, str or bytes).
+    :param user_id: Author of every imported post; without it, each line's 'author' username is looked up.
+    :param on_batch: Called with the list of inserted rows (each with its new 'id') after each commit.
+    :return: {'rows', 'errors', 'error_samples', 'seconds', 'rows_per_sec'}. Lines that cannot be
+        imported are skipped and counted; batches committed before a database error stay committed.
+    """
+    started = time.perf_counter()
+    stats = {'rows': 0, 'errors': 0, 'error_samples': []}
+    user_ids = {}
+
+    def error(number, message):
+        stats['errors'] += 1
+        if len(stats['error_samples']) < max_error_samples:
+            stats['error_samples'].append({'line': number, 'error': message})
+
+    def flush(pending):
+        if user_id is None:
+            unknown = {author for _, _, author in pending if author not in user_ids}
+            if unknown:
+                with engine.connect() as connection:
+                    user_ids.update(connection.execute(select(users_table.c.username, users_table.c.id)
+                                                       .where(users_table.c.username.in_(unknown))).all())
+        rows = []
+        for number, row, author in pending:
+            row['user_id'] = user_id if user_id is not None else user_ids.get(author)
+            if row['user_id'] is None:
+                error(number, f'unknown author {author!r}')
+            else:
+                rows.append(row)
+        if not rows:
+            return
+        with engine.begin() as connection:
+            ids = connection.execute(insert(posts_table).returning(posts_table.c.id, sort_by_parameter_order=True),
+                                     rows).scalars().all()
+            counts = Counter(row['user_id'] for row in rows)
+            connection.execute(update(users_table).where(users_table.c.id == bindparam('author_id'))
+                               .values(post_count=users_table.c.post_count + bindparam('added')),
+                               [{'author_id': author_id, 'added': added} for author_id, added in counts.items()])
+        for row, post_id in zip(rows, ids):
+            row['id'] = post_id
+        stats['rows'] += len(rows)
+        if on_batch is not None:
+            on_batch(rows)
+
+    pending = []
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if not line.strip():
+            continue
+        try:
+            row, author = parse_post(line)
+        except (ValueError, TypeError) as e:
+            error(number, str(e))
+            continue
+        pending.append((number, row, author))
+        if len(pending) >= batch_size:
+            flush(pending)
+            pending = []
+    if pending:
+        flush(pending)
+
+    seconds = time.perf_counter() - started
+    transfer_stats.record('import', stats['rows'], seconds, stats['errors'])
+    stats['seconds'] = round(seconds, 3)
+    stats['rows_per_sec'] = round(stats['rows'] / seconds, 1) if seconds else 0.0
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export or import posts as NDJSON.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='write every post to stdout (or --output)')
+    export.add_argument('--output', help='file to write instead of stdout')
+    export.add_argument('--author', help='only this username\'s posts')
+    export.add_argument('--batch-size', type=int, default=1000, help='rows fetched per round trip')
+    load = commands.add_parser('import', help='insert the posts of an NDJSON file ("-" for stdin)')
+    load.add_argument('path')
+    load.add_argument('--author', help='username to attribute every post to, instead of each line\'s "author"')
+    load.add_argument('--batch-size', type=int, default=1000, help='rows per INSERT and transaction')
+    args = parser.parse_args(argv)
+
+    from database.sql_db.connect import engine
+
+    user_id = None
+    if args.author:
+        with engine.connect() as connection:
+            user_id = connection.execute(select(users_table.c.id)
+                                         .where(users_table.c.username == args.author)).scalar()
+        if user_id is None:
+            parser.error(f'no user named {args.author!r}')
+
+    if args.command == 'export':
+        output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+        try:
+            output.writelines(export_posts(engine, args.batch_size, user_id,
+                                           report=lambda stats: print(json.dumps(stats), file=sys.stderr)))
+        finally:
+            if args.output:
+                output.close()
+    else:
+        source = sys.stdin if args.path == '-' else open(args.path, encoding='utf-8')
+        try:
+            stats = import_posts(engine, source, args.batch_size, user_id)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
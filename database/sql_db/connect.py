@@ -1,6 +1,10 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from flask import g, has_app_context
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 # Load environment variables from the .env file
@@ -8,10 +12,91 @@ load_dotenv()
 
 
 SQLALCHEMY_DATABASE_URL = os.getenv('SQLALCHEMY_DATABASE_URL')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 15))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+# Logs every statement synchronously; statement counts and timings are in the /metrics endpoint instead.
+SQLALCHEMY_ECHO = os.getenv('SQLALCHEMY_ECHO', '').lower() in ('1', 'true', 'yes')
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True, pool_size=15)
+
+class PoolStats:
+    """Counters fed by the connection pool: checkouts, time spent waiting for a connection, overflow."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.peak_checked_out = 0
+        self.peak_overflow = 0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self, pool):
+        with self._lock:
+            return {
+                'pool_size': pool.size(),
+                'max_overflow': DB_MAX_OVERFLOW,
+                'checked_out': pool.checkedout(),
+                'overflow': max(pool.overflow(), 0),
+                'peak_checked_out': self.peak_checked_out,
+                'peak_overflow': self.peak_overflow,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'connects': self.connects,
+                'wait_total_ms': round(self.wait_total * 1000, 3),
+                'wait_avg_ms': round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+            }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a free connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record_wait(time.perf_counter() - start)
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=SQLALCHEMY_ECHO, poolclass=InstrumentedQueuePool,
+                       pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
 Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-session_db = Session()
+
+
+@event.listens_for(engine, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    with pool_stats._lock:
+        pool_stats.connects += 1
+
+
+@event.listens_for(engine, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool = engine.pool
+    with pool_stats._lock:
+        pool_stats.checkouts += 1
+        pool_stats.peak_checked_out = max(pool_stats.peak_checked_out, pool.checkedout())
+        pool_stats.peak_overflow = max(pool_stats.peak_overflow, pool.overflow())
+
+
+@event.listens_for(engine, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    with pool_stats._lock:
+        pool_stats.checkins += 1
+
+
+def pool_status():
+    return pool_stats.snapshot(engine.pool)
 
 
 # Dependency
@@ -21,3 +106,40 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def _session_scope():
+    """
+    Scope key for session_db: the current Flask app context (pushed for every HTTP request and every
+    Socket.IO event), or the current thread/greenlet outside of one (scripts, background workers).
+    """
+    if has_app_context():
+        return id(g._get_current_object())
+    return threading.get_ident()
+
+
+def _open_session():
+    """Opens a session through get_db() and keeps the generator so teardown can finalize it."""
+    generator = get_db()
+    db = next(generator)
+    db.info['generator'] = generator
+    return db
+
+
+session_db = scoped_session(_open_session, scopefunc=_session_scope)
+
+
+def remove_session(exception=None):
+    """Closes the session of the current scope; the next access in this scope opens a new one."""
+    if session_db.registry.has():
+        db = session_db.registry()
+        generator = db.info.pop('generator', None)
+        if exception is not None:
+            db.rollback()
+        if generator is not None:
+            generator.close()
+    session_db.registry.clear()
+
+
+def init_app(app):
+    app.teardown_appcontext(remove_session)
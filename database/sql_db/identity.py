@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from database.sql_db.models import User
+
+
+class UserSnapshot:
+    """
+    The columns of a User that requests read through current_user, detached from any session, so
+    one snapshot can serve many requests. Compares equal to the User (or snapshot) with the same id.
+    """
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.image_file = user.image_file
+        self.is_active = bool(user.is_active)
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, (User, UserSnapshot)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class IdentityCache:
+    """
+    Per-process cache of UserSnapshots for the login manager's user_loader. Views that change a user
+    call invalidate(); the `ttl` bounds how long other worker processes keep serving the old snapshot.
+    """
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, session, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and monotonic() - entry[1] < self.ttl:
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        user = session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot(user)
+        with self._lock:
+            self._users[user_id] = (snapshot, monotonic())
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_entries:
+                self._users.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._users.pop(int(user_id), None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._users),
+                'lookups': lookups,
+                'db_round_trips_saved': self.hits,
+                'db_round_trips_saved_per_request': round(self.hits / lookups, 4) if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
+
+
+identity_cache = IdentityCache()
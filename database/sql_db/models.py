@@ -1,5 +1,5 @@
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, Boolean, func
+from sqlalchemy import Column, Integer, String, Boolean, Index, func, event, insert, update
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.schema import ForeignKey
 from sqlalchemy.sql.sqltypes import DateTime
@@ -23,6 +23,8 @@ class User(Base, UserMixin):
     image_file = Column(String(40), nullable=False, default='default.jpg')
     created_at = Column('created_at', DateTime, default=func.now())
     is_active = Column(Boolean, default=False)
+    # Kept in step with the posts table by the Post insert/delete events below.
+    post_count = Column(Integer, nullable=False, default=0, server_default='0')
     posts = relationship("Post", back_populates="user", cascade="all, delete-orphan")
 
     def get_reset_token(self, expires_in=600):
@@ -49,3 +51,38 @@ class Post(Base):
     user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
     user = relationship("User", back_populates="posts")
 
+    # Keyset pagination seeks on (created_at, id), overall and per author.
+    __table_args__ = (
+        Index('ix_posts_created_at_id', 'created_at', 'id'),
+        Index('ix_posts_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    )
+
+
+class PostChange(Base):
+    """
+    One row per edited or deleted post, written by the Post events below. Web workers read the rows
+    past the last one they saw to keep their search index up to date; new posts need no row, as
+    their ids keep growing.
+    """
+    __tablename__ = "post_changes"
+    id = Column(Integer, primary_key=True)
+    post_id = Column(Integer, nullable=False)
+
+
+@event.listens_for(Post, 'after_insert')
+def _count_new_post(mapper, connection, post):
+    # Runs on the flush's connection, so the counter commits or rolls back together with the post.
+    users = User.__table__
+    connection.execute(update(users).where(users.c.id == post.user_id).values(post_count=users.c.post_count + 1))
+
+
+@event.listens_for(Post, 'after_update')
+def _log_updated_post(mapper, connection, post):
+    connection.execute(insert(PostChange.__table__).values(post_id=post.id))
+
+
+@event.listens_for(Post, 'after_delete')
+def _count_deleted_post(mapper, connection, post):
+    users = User.__table__
+    connection.execute(update(users).where(users.c.id == post.user_id).values(post_count=users.c.post_count - 1))
+    connection.execute(insert(PostChange.__table__).values(post_id=post.id))
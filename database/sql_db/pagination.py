@@ -0,0 +1,129 @@
+import base64
+import json
+import threading
+from collections import namedtuple
+from datetime import datetime
+from time import monotonic
+
+from sqlalchemy import and_, or_, func
+
+from database.sql_db.models import Post
+
+
+PostPage = namedtuple('PostPage', ['posts', 'next_cursor', 'prev_cursor'])
+
+
+def encode_cursor(post, direction):
+    """
+    Builds an opaque cursor pointing at a post on the (date_posted, id) keyset.
+    :param post: The post the next page starts after (or the previous page ends before).
+    :param direction: 'n' for the next page, 'p' for the previous page.
+    :return: A url-safe string.
+    """
+    payload = json.dumps({'d': post.date_posted.isoformat(), 'i': post.id, 'dir': direction},
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Reverses encode_cursor.
+    :return: A (direction, date_posted, post_id) tuple, or None if the cursor is malformed.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        direction = payload['dir']
+        if direction not in ('n', 'p'):
+            return None
+        return direction, datetime.fromisoformat(payload['d']), int(payload['i'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def paginate_posts(query, page, cursor, per_page):
+    """
+    Returns one page of posts ordered by (date_posted, id).
+    With a valid cursor the page is fetched with a keyset seek, so deep pages cost the same as the
+    first one. Without a cursor (a jump from the page strip) it falls back to OFFSET.
+    :param query: A Post query, optionally already filtered (e.g. by author).
+    :param page: The page number, used only by the OFFSET fallback.
+    :param cursor: An opaque cursor from a previous page, or None.
+    :param per_page: Number of posts per page.
+    :return: A PostPage.
+    """
+    decoded = decode_cursor(cursor) if cursor else None
+
+    if decoded is None:
+        rows = query.order_by(Post.date_posted.asc(), Post.id.asc()) \
+            .offset((page - 1) * per_page).limit(per_page + 1).all()
+        has_next, has_prev = len(rows) > per_page, page > 1
+        posts = rows[:per_page]
+    else:
+        direction, date_posted, post_id = decoded
+        if direction == 'n':
+            rows = query.filter(or_(Post.date_posted > date_posted,
+                                    and_(Post.date_posted == date_posted, Post.id > post_id))) \
+                .order_by(Post.date_posted.asc(), Post.id.asc()).limit(per_page + 1).all()
+            has_next, has_prev = len(rows) > per_page, True
+            posts = rows[:per_page]
+        else:
+            rows = query.filter(or_(Post.date_posted < date_posted,
+                                    and_(Post.date_posted == date_posted, Post.id < post_id))) \
+                .order_by(Post.date_posted.desc(), Post.id.desc()).limit(per_page + 1).all()
+            has_next, has_prev = True, len(rows) > per_page
+            posts = list(reversed(rows[:per_page]))
+
+    next_cursor = encode_cursor(posts[-1], 'n') if posts and has_next else None
+    prev_cursor = encode_cursor(posts[0], 'p') if posts and has_prev else None
+    return PostPage(posts, next_cursor, prev_cursor)
+
+
+class PostCounter:
+    """
+    Post totals for the page strip, counted once and then kept up to date by the post create and
+    delete paths instead of running COUNT(*) on every page view. Entries are re-counted after `ttl`
+    seconds so changes made by other worker processes are picked up eventually.
+    """
+
+    ALL = None
+
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def total(self, session, user_id=ALL):
+        with self._lock:
+            entry = self._counts.get(user_id)
+            if entry is not None and monotonic() - entry[1] < self.ttl:
+                return entry[0]
+
+        query = session.query(func.count(Post.id))
+        if user_id is not self.ALL:
+            query = query.filter(Post.user_id == user_id)
+        count = query.scalar()
+
+        with self._lock:
+            if len(self._counts) >= self.max_entries and user_id not in self._counts:
+                self._counts.pop(next(iter(self._counts)))
+            self._counts[user_id] = (count, monotonic())
+        return count
+
+    def add(self, user_id, delta=1):
+        with self._lock:
+            for key in (self.ALL, user_id):
+                entry = self._counts.get(key)
+                if entry is not None:
+                    self._counts[key] = (max(entry[0] + delta, 0), entry[1])
+
+    def invalidate(self, user_id=ALL):
+        with self._lock:
+            if user_id is self.ALL:
+                self._counts.clear()
+            else:
+                self._counts.pop(user_id, None)
+
+
+post_counter = PostCounter()
@@ -0,0 +1,321 @@
+import logging
+import os
+import queue
+import random
+import smtplib
+import threading
+import time
+from collections import namedtuple
+
+from flask_mail import BadHeaderError, sanitize_address
+
+
+OutboundMail = namedtuple('OutboundMail', ['sender', 'recipients', 'body', 'enqueued_at', 'attempts'])
+
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+def is_permanent(error):
+    """Whether retrying cannot help: the server rejected the message with a 5xx reply."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return bool(error.recipients) and all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+class SMTPTransport:
+    """
+    Keeps one authenticated SMTP connection open and reuses it for every message.
+    Not thread-safe: each mail worker gets its own instance.
+    """
+
+    def __init__(self, host, port, use_ssl=False, use_tls=False, username=None, password=None, timeout=30,
+                 keepalive=60):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self._connection = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        if self.use_ssl:
+            connection = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.use_tls:
+                connection.starttls()
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+        return connection
+
+    def _ensure_connection(self):
+        if self._connection is not None and time.monotonic() - self._last_used > self.keepalive:
+            try:
+                self._connection.noop()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+        if self._connection is None:
+            self._connection = self._connect()
+
+    def send(self, mail):
+        self._ensure_connection()
+        try:
+            refused = self._connection.sendmail(mail.sender, mail.recipients, mail.body)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.close()
+            raise
+        self._last_used = time.monotonic()
+        if refused:
+            # The message went to the other recipients; these ones are not retried.
+            logger.warning('Mail from %s was refused for %s', mail.sender,
+                           ', '.join(f'{recipient} ({code} {text!r})' for recipient, (code, text) in refused.items()))
+
+    def close(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._connection = None
+
+
+class MemoryTransport:
+    """Collects messages in a list instead of sending them. Meant for tests and benchmarks."""
+
+    def __init__(self):
+        self.outbox = []
+        self._lock = threading.Lock()
+
+    def send(self, mail):
+        with self._lock:
+            self.outbox.append(mail)
+
+    def close(self):
+        pass
+
+
+class FileTransport:
+    """Writes every message to its own .eml file in `directory`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._counter = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, mail):
+        with self._lock:
+            self._counter += 1
+            name = f'{time.time():.6f}-{os.getpid()}-{self._counter}.eml'
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(mail.body)
+
+    def close(self):
+        pass
+
+
+class MailQueue:
+    """
+    In-process outbound mail queue. Messages are rendered in the request, then delivered by worker
+    threads that each keep one transport (SMTP connection) open, take up to `batch_size` messages at a
+    time and retry transient failures with exponential backoff. Messages the server rejects outright
+    (5xx) are not retried; every message given up on is logged.
+    """
+
+    def __init__(self, transport_factory, workers=1, batch_size=20, batch_wait=0.05, max_attempts=5,
+                 backoff=1.0, max_backoff=60.0, idle_timeout=30.0):
+        self.transport_factory = transport_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+
+        self._queue = queue.Queue()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._in_flight = 0
+
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retried = 0
+        self.batches = 0
+        self.send_time_total = 0.0
+        self.send_time_max = 0.0
+        self.delivery_time_total = 0.0
+        self.delivery_time_max = 0.0
+
+    @classmethod
+    def from_app(cls, app):
+        config = app.config
+        kind = config.get('MAIL_TRANSPORT', 'smtp')
+        if kind == 'memory':
+            transport = MemoryTransport()
+            factory = lambda: transport
+        elif kind == 'file':
+            transport = FileTransport(config.get('MAIL_FILE_DIR') or os.path.join(app.instance_path, 'mail'))
+            factory = lambda: transport
+        else:
+            factory = lambda: SMTPTransport(config.get('MAIL_SERVER'), int(config.get('MAIL_PORT') or 0),
+                                            use_ssl=config.get('MAIL_USE_SSL', False),
+                                            use_tls=config.get('MAIL_USE_TLS', False),
+                                            username=config.get('MAIL_USERNAME'),
+                                            password=config.get('MAIL_PASSWORD'))
+        return cls(factory,
+                   workers=int(config.get('MAIL_QUEUE_WORKERS', 1)),
+                   batch_size=int(config.get('MAIL_BATCH_SIZE', 20)),
+                   max_attempts=int(config.get('MAIL_MAX_ATTEMPTS', 5)))
+
+    def _ensure_started(self):
+        # Worker threads do not survive fork(), so a forked web worker starts its own.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = [threading.Thread(target=self._run, name=f'mail-worker-{n}', daemon=True)
+                             for n in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def enqueue(self, message):
+        """
+        Queues a flask_mail.Message for delivery. Must be called within the application context,
+        which is where the message is serialized.
+        """
+        assert message.send_to, 'No recipients have been added'
+        assert message.sender, 'The message does not specify a sender'
+        if message.has_bad_headers():
+            raise BadHeaderError
+        if message.date is None:
+            message.date = time.time()
+
+        mail = OutboundMail(sanitize_address(message.sender),
+                            [sanitize_address(recipient) for recipient in message.send_to],
+                            message.as_bytes(), time.monotonic(), 0)
+        self._ensure_started()
+        with self._lock:
+            self._in_flight += 1
+            self.enqueued += 1
+        self._queue.put(mail)
+
+    def _next_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        transport = self.transport_factory()
+        while True:
+            try:
+                first = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                transport.close()
+                continue
+            if first is _STOP:
+                transport.close()
+                return
+            batch = self._next_batch(first)
+            with self._lock:
+                self.batches += 1
+            for mail in batch:
+                self._deliver(transport, mail)
+
+    def _deliver(self, transport, mail):
+        start = time.monotonic()
+        try:
+            transport.send(mail)
+        except Exception as e:
+            self._retry(mail, e)
+            return
+        finished = time.monotonic()
+        with self._lock:
+            self.sent += 1
+            self.send_time_total += finished - start
+            self.send_time_max = max(self.send_time_max, finished - start)
+            self.delivery_time_total += finished - mail.enqueued_at
+            self.delivery_time_max = max(self.delivery_time_max, finished - mail.enqueued_at)
+            self._done()
+
+    def _retry(self, mail, error):
+        mail = mail._replace(attempts=mail.attempts + 1)
+        permanent = is_permanent(error)
+        if permanent or mail.attempts >= self.max_attempts:
+            logger.error('Gave up on mail from %s to %s after %d attempt(s)%s: %r', mail.sender,
+                         ', '.join(mail.recipients), mail.attempts, ', rejected by the server' if permanent else '',
+                         error)
+            with self._lock:
+                self.failed += 1
+                if permanent:
+                    self.rejected += 1
+                self._done()
+            return
+        with self._lock:
+            self.retried += 1
+        delay = min(self.backoff * 2 ** (mail.attempts - 1), self.max_backoff) * random.uniform(0.5, 1.0)
+        timer = threading.Timer(delay, self._queue.put, (mail,))
+        timer.daemon = True
+        timer.start()
+
+    def _done(self):
+        self._in_flight -= 1
+        if self._in_flight == 0:
+            self._idle.notify_all()
+
+    def join(self, timeout=None):
+        """Blocks until every queued message has been sent or given up on."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout)
+
+    def stop(self, timeout=None):
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._pid = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'in_flight': self._in_flight,
+                'enqueued': self.enqueued,
+                'sent': self.sent,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'retried': self.retried,
+                'batches': self.batches,
+                'send_avg_ms': round(self.send_time_total * 1000 / self.sent, 3) if self.sent else 0.0,
+                'send_max_ms': round(self.send_time_max * 1000, 3),
+                'delivery_avg_ms': round(self.delivery_time_total * 1000 / self.sent, 3) if self.sent else 0.0,
+                'delivery_max_ms': round(self.delivery_time_max * 1000, 3),
+            }
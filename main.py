@@ -1,45 +1,131 @@
-from flask import render_template, url_for, flash, redirect, request, session
+import os
+from datetime import timezone
+
+from PIL import UnidentifiedImageError
+from flask import render_template, url_for, flash, redirect, request, session, abort, send_from_directory, \
+    Response, jsonify
 from flask_login import login_user, current_user, logout_user, login_required
 from forms import RegistrationForm, LoginForm, UpdateAccountForm, PostForm, RequestResetForm, ResetPasswordForm, \
     ConfirmEmailForm
-from system import app, login_manager, bcrypt, save_picture, pagination_range, send_reset_email, send_confirm_email
+from system import app, login_manager, password_hasher, save_picture, pagination_range, send_reset_email, send_confirm_email, \
+    avatar_pipeline, mail_queue
 
-from flask_socketio import SocketIO, join_room, leave_room, send
+from flask_socketio import SocketIO, join_room, leave_room
+from sqlalchemy.orm import joinedload
 
 from database.sql_db.models import User, Post
-from database.sql_db.connect import session_db
+from database.sql_db.connect import engine, session_db, pool_status, init_app as init_db_session
+from database.sql_db.pagination import paginate_posts, post_counter
+from database.sql_db.identity import identity_cache
+from database.sql_db.bulk import export_posts, import_posts, transfer_stats
+from page_cache import PageCache, backend_from_url
+from passwords import HasherBusy
+from metrics import Metrics
+from database.mongo_db.mongo_connect import chat_collection, mongo_collection, answer_cache_collection
+from chat.history import ChatHistory
+from chat.registry import registry_from_url
+from chat.broker import queue_options
+from chat.broadcast import RoomBroadcaster
+from text_search import PostSearch, DocumentSearch
+from ai.inference import InferenceEngine, QueueFull
+from ai.context import ContextBuilder, ASSISTANT
+from ai.models import configure as configure_models
+from ai.answer_cache import AnswerCache
+from ai.vector_index import VectorIndex, Retriever
+
+init_db_session(app)
+# With a message queue, broadcasts from any worker process reach clients connected to the others.
+socketio = SocketIO(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+                    **queue_options(app.config['SOCKETIO_MESSAGE_QUEUE']))
+broadcaster = RoomBroadcaster.from_app(app, socketio)
+room_registry = registry_from_url(app.config['CHAT_ROOM_REGISTRY'])
+chat_history = ChatHistory(chat_collection, capacity=app.config['CHAT_HISTORY_SIZE'],
+                           sequence=room_registry.next_seq,
+                           shared=app.config['CHAT_ROOM_REGISTRY'] != 'memory://')
+post_search = PostSearch(engine)
+document_search = DocumentSearch(mongo_collection)
+models = configure_models(app)
+models.preload(app.config['PRELOAD_MODELS'])
+inference_engine = InferenceEngine(lambda: models.get('generator'),
+                                   max_batch_size=app.config['INFERENCE_MAX_BATCH'],
+                                   max_wait=app.config['INFERENCE_MAX_WAIT_MS'] / 1000)
+answer_cache = AnswerCache(answer_cache_collection, mongo_collection,
+                           embedder=(lambda: models.get('embedder')) if app.config['ANSWER_CACHE_SIMILARITY'] else None,
+                           capacity=app.config['ANSWER_CACHE_SIZE'], ttl=app.config['ANSWER_CACHE_TTL'],
+                           threshold=app.config['ANSWER_CACHE_SIMILARITY'])
+retriever = Retriever(VectorIndex(app.config['VECTOR_INDEX_DIR']), lambda: models.get('embedder'), mongo_collection,
+                      nprobe=app.config['VECTOR_INDEX_NPROBE']) if app.config['VECTOR_INDEX_DIR'] else None
+context_builder = ContextBuilder.from_app(
+    app, tokenizer=lambda: models.get('tokenizer'),
+    history=lambda room: chat_history.recent(room, app.config['CHAT_HISTORY_SIZE']),
+    prefill_rate=lambda: models.get('generator').prefill_rate() if models.loaded('generator') else None)
+if app.config['INFERENCE_MODEL']:
+    context_builder.load_tokenizer()
+page_cache = PageCache(backend_from_url(app.config['PAGE_CACHE_BACKEND']), ttl=app.config['PAGE_CACHE_TTL'])
+
+metrics = Metrics.from_app(app)
+metrics.init_app(app, engine)
+metrics.register('db_pool', pool_status)
+metrics.register('mail_queue', mail_queue.stats)
+metrics.register('inference', inference_engine.stats)
+metrics.register('answer_cache', answer_cache.stats)
+metrics.register('identity_cache', identity_cache.stats)
+metrics.register('page_cache', page_cache.stats)
+metrics.register('password_hasher', password_hasher.stats)
+metrics.register('models', models.stats)
+metrics.register('post_transfer', transfer_stats.stats)
+metrics.register('chat_broadcast', broadcaster.stats)
+metrics.register('context', context_builder.stats)
+metrics.register('post_search', post_search.stats)
+metrics.register('document_search', document_search.stats)
+post_search.start()
+document_search.start()
+
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(error):
+    return str(error), 503, {'Retry-After': '1'}
 
-socketio = SocketIO(app)
-rooms = {}
 
 @login_manager.user_loader
 def load_user(user_id):
-    return session_db.query(User).filter_by(id=user_id).first()
+    return identity_cache.get(session_db, user_id)
+
+
+def render_post_list(template, query, page, cursor, per_page, total_posts, **context):
+    """Renders one page of posts with its page strip, as a dict for page_cache.fragment()."""
+    posts, next_cursor, prev_cursor = paginate_posts(query, page, cursor, per_page)
+    total_pages = (total_posts // per_page) + (1 if total_posts % per_page else 0)
+    html = render_template(template, posts=posts, page=page, total_pages=total_pages,
+                           pagination_range=pagination_range(page, total_pages), total_posts=total_posts,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor, **context)
+    dates = [post.date_posted.replace(tzinfo=timezone.utc).timestamp() for post in posts if post.date_posted]
+    return {'html': html, 'last_modified': max(dates, default=None)}
 
 
 @app.route("/", methods=["POST", "GET"])
 @app.route("/home", methods=["POST", "GET"])
+@page_cache.cached
 def home():
-    page = request.args.get('page', 1, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    cursor = request.args.get('cursor')
     per_page = 5
-    offset = (page - 1) * per_page
-
-    total_posts = session_db.query(Post).count()
-    posts = session_db.query(Post).order_by(Post.date_posted.asc()).offset(offset).limit(per_page).all()
-    total_pages = (total_posts // per_page) + (1 if total_posts % per_page else 0)
-    pagination = pagination_range(page, total_pages)
 
     if request.method == "POST":
         name = current_user.username
 
         room = "AAAA"
-        rooms[room] = {"members": 0, "messages": []}
+        room_registry.create(room)
 
 
         session["room"] = room
         session["name"] = name
         return redirect(url_for("room"))
-    return render_template('home.html', posts=posts, page=page, total_pages=total_pages, pagination_range=pagination)
+
+    listing = page_cache.fragment('home', [page, cursor], lambda: render_post_list(
+        '_home_list.html', session_db.query(Post).options(joinedload(Post.user)), page, cursor, per_page,
+        post_counter.total(session_db)))
+    return render_template('home.html', posts_html=listing['html'])
 
 
 @app.route("/about")
@@ -53,7 +139,7 @@ def register():
         return redirect(url_for('home'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = password_hasher.hash(form.password.data)
         user = User(username=form.username.data, email=form.email.data, password=hashed_password)
         session_db.add(user)
         session_db.commit()
@@ -72,7 +158,9 @@ def login():
     if form.validate_on_submit():
         user = session_db.query(User).filter_by(email=form.email.data).first()
 
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        if user and password_hasher.check_and_rehash(user, form.password.data):
+            # Saves the new hash when the password was stored with an outdated cost factor.
+            session_db.commit()
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             if user.is_active == False:
@@ -99,10 +187,13 @@ def account():
     form = UpdateAccountForm()
     previous_email = current_user.email
     if form.validate_on_submit():
+        user = session_db.get(User, current_user.id)
         if form.picture.data:
-            picture_file = save_picture(form.picture.data)
-            current_user.image_file = picture_file
-        user = session_db.query(User).filter_by(username=current_user.username).first()
+            try:
+                user.image_file = save_picture(form.picture.data)
+            except UnidentifiedImageError:
+                flash('That file is not an image we can read.', 'danger')
+                return redirect(url_for('account'))
         user.username = form.username.data
         user.email = form.email.data
         if previous_email != form.email.data:
@@ -110,6 +201,9 @@ def account():
             send_confirm_email(user)
 
         session_db.commit()
+        identity_cache.invalidate(user.id)
+        # Post lists show the author's name and picture.
+        page_cache.invalidate()
 
         flash('Your account has been updated!', 'success')
         logout_user()
@@ -117,9 +211,21 @@ def account():
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.email.data = current_user.email
-    image_file = url_for('static', filename='profile_pics/' + current_user.image_file)
     return render_template('account.html', title='Account',
-                           image_file=image_file, form=form)
+                           image_file=current_user.image_file, form=form)
+
+
+@app.route("/avatars/<filename>")
+def avatar(filename):
+    """Avatar files are named after their content, so browsers may keep them for good."""
+    if not os.path.exists(os.path.join(avatar_pipeline.directory, filename)):
+        # Still being resized; show the default picture without letting it be cached.
+        response = send_from_directory(avatar_pipeline.directory, 'default.jpg', max_age=0)
+        response.cache_control.no_cache = True
+        return response
+    response = send_from_directory(avatar_pipeline.directory, filename, max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route("/post/new", methods=['GET', 'POST'])
@@ -130,14 +236,21 @@ def new_post():
         post = Post(title=form.title.data, content=form.content.data, user_id=current_user.id)
         session_db.add(post)
         session_db.commit()
+        post_counter.add(current_user.id)
+        post_search.add_post(post)
+        page_cache.invalidate()
         flash('Your post has been posted!', 'success')
         return redirect(url_for('home'))
     return render_template('create_post.html', title='New post', form=form, legend='New Post')
 
 
 @app.route("/post/<int:post_id>")
+@page_cache.cached
 def post(post_id):
-    post = session_db.get(Post, post_id)
+    post = session_db.get(Post, post_id, options=[joinedload(Post.user)])
+    if post is None:
+        abort(404)
+    page_cache.mark_modified(post.date_posted)
     return render_template('post.html', title='New post', post=post)
 
 
@@ -145,7 +258,7 @@ def post(post_id):
 @login_required
 def update_post(post_id):
     post = session_db.get(Post, post_id)
-    if post.user != current_user:
+    if post.user_id != current_user.id:
         flash('You dont have the permission to edit others posts!', 'danger')
         return redirect(url_for('home'))
     form = PostForm()
@@ -153,6 +266,8 @@ def update_post(post_id):
         post.title = form.title.data
         post.content = form.content.data
         session_db.commit()
+        post_search.add_post(post)
+        page_cache.invalidate()
         flash('Your post has been updated!', 'success')
         return redirect(url_for('post', post_id=post.id))
     elif request.method == 'GET':
@@ -165,31 +280,98 @@ def update_post(post_id):
 @login_required
 def delete_post(post_id):
     post = session_db.get(Post, post_id)
-    if post.user != current_user:
+    if post.user_id != current_user.id:
         flash('You dont have the permission to delete others posts!', 'danger')
         return redirect(url_for('home'))
     session_db.delete(post)
     session_db.commit()
+    post_counter.add(post.user_id, -1)
+    post_search.remove_post(post_id)
+    page_cache.invalidate()
     flash('Your post has been deleted!', 'success')
     return redirect(url_for('home'))
 
 
 @app.route("/user/<string:username>")
+@page_cache.cached
 def user_posts(username):
-    page = request.args.get('page', 1, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    cursor = request.args.get('cursor')
     per_page = 5
-    offset = (page - 1) * per_page
 
-    total_posts = session_db.query(Post).join(User).filter(User.username == username).count()
-    posts = session_db.query(Post).join(User).filter(User.username == username).order_by(Post.date_posted.asc()).offset(
-        offset).limit(per_page).all()
-    total_pages = (total_posts // per_page) + (1 if total_posts % per_page else 0)
-    pagination = pagination_range(page, total_pages)
+    def render():
+        user = session_db.query(User).filter_by(username=username).first()
+        if user is None:
+            abort(404)
+        posts = session_db.query(Post).filter(Post.user_id == user.id).options(joinedload(Post.user))
+        return render_post_list('_user_posts_list.html', posts, page, cursor, per_page, user.post_count, user=user)
+
+    listing = page_cache.fragment('user_posts', [username, page, cursor], render)
+    return render_template('user_posts.html', posts_html=listing['html'])
+
+
+@app.route("/api/posts/export")
+@login_required
+def api_export_posts():
+    """Streams every post (or ?author=<username>'s) as NDJSON."""
+    user_id = None
+    if request.args.get('author'):
+        author = session_db.query(User).filter_by(username=request.args['author']).first()
+        if author is None:
+            abort(404)
+        user_id = author.id
+
+    def report(stats):
+        app.logger.info("Exported %d posts in %.3fs (%.1f rows/s)", stats['rows'], stats['seconds'],
+                        stats['rows_per_sec'])
+
+    batch_size = min(max(request.args.get('batch_size', 1000, type=int), 1), 5000)
+    return Response(export_posts(engine, batch_size, user_id, report=report), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=posts.ndjson'})
 
-    user = session_db.query(User).filter_by(username=username).first()
 
-    return render_template('user_posts.html', posts=posts, page=page, total_pages=total_pages, user=user,
-                           pagination_range=pagination, total_posts=total_posts)
+@app.route("/api/posts/import", methods=['POST'])
+@login_required
+def api_import_posts():
+    """Imports an NDJSON request body as posts of the current user, reading it line by line."""
+    def index(rows):
+        for row in rows:
+            post_search.add_post(Post(id=row['id'], title=row['title'], content=row['description']))
+
+    batch_size = min(max(request.args.get('batch_size', 1000, type=int), 1), 5000)
+    stats = import_posts(engine, request.stream, batch_size, user_id=current_user.id, on_batch=index)
+    if stats['rows']:
+        post_counter.invalidate()
+        page_cache.invalidate()
+    app.logger.info("Imported %d posts in %.3fs (%.1f rows/s), %d lines skipped", stats['rows'], stats['seconds'],
+                    stats['rows_per_sec'], stats['errors'])
+    return jsonify(stats), 400 if stats['errors'] and not stats['rows'] else 200
+
+
+@app.route("/search")
+def search():
+    query = request.args.get('q', '').strip()
+    scope = 'documents' if request.args.get('scope') == 'documents' else 'posts'
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 10
+
+    total_results, results = 0, []
+    if query:
+        if scope == 'documents':
+            total_results, hits = document_search.search(query, per_page, (page - 1) * per_page)
+            found = {document['_id']: document for document in
+                     mongo_collection.find({'_id': {'$in': [key for key, _ in hits]}})}
+        else:
+            total_results, hits = post_search.search(query, per_page, (page - 1) * per_page)
+            found = {post.id: post for post in
+                     session_db.query(Post).options(joinedload(Post.user))
+                     .filter(Post.id.in_([key for key, _ in hits]))}
+        results = [found[key] for key, _ in hits if key in found]
+
+    total_pages = (total_results // per_page) + (1 if total_results % per_page else 0)
+    pagination = pagination_range(page, total_pages)
+    return render_template('search.html', title='Search', query=query, scope=scope, results=results, page=page,
+                           total_pages=total_pages, total_results=total_results, pagination_range=pagination)
 
 
 @app.route("/reset_password", methods=['GET', 'POST'])
@@ -215,9 +397,10 @@ def reset_token(token):
         return redirect(url_for('reset_request'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = password_hasher.hash(form.password.data)
         user.password = hashed_password
         session_db.commit()
+        identity_cache.invalidate(user.id)
         flash('Your password has been updated! You are now able to log in', 'success')
         return redirect(url_for('login'))
     return render_template('reset_token.html', title='Reset Password', form=form)
@@ -238,67 +421,141 @@ def confirm_email(token):
     if form.validate_on_submit():
         user.is_active = True
         session_db.commit()
+        identity_cache.invalidate(user.id)
         flash('Your Email is confirmed.', 'info')
         return redirect(url_for('login'))
-    image_file = url_for('static', filename='profile_pics/' + user.image_file)
-    return render_template('confirm_email.html', title='Confirm Email', form=form, user=user, image_file=image_file)
+    return render_template('confirm_email.html', title='Confirm Email', form=form, user=user,
+                           image_file=user.image_file)
 
 
 @app.route("/room")
 def room():
     room = session.get("room")
-    if room is None or session.get("name") is None or room not in rooms:
+    if room is None or session.get("name") is None or not room_registry.exists(room):
         return redirect(url_for("home"))
 
-    return render_template("chat/room.html", code=room, messages=rooms[room]["messages"])
+    return render_template("chat/room.html", code=room,
+                           messages=chat_history.recent(room, app.config['CHAT_PAGE_SIZE']),
+                           broadcast_encoding=broadcaster.encoding)
 
 
 @socketio.on("connect")
+@metrics.socket_event
 def connect(auth):
     room = session.get("room")
     name = session.get("name")
     if not room or not name:
         return
-    if room not in rooms:
+    members = room_registry.join(room)
+    if members is None:
         leave_room(room)
         return
 
     join_room(room)
-    send({"name": name, "message": "has entered the room"}, to=room)
-    rooms[room]["members"] += 1
-    print(f"{name} joined room {room}")
+    metrics.room_size(room, members)
+    # Socket.IO sessions are per connection, so this marks the membership disconnect has to undo.
+    session["joined_room"] = room
+    broadcaster.publish(room, {"name": name, "message": "has entered the room"})
+    app.logger.debug("%s joined room %s", name, room)
 
 
 @socketio.on("disconnect")
+@metrics.socket_event
 def disconnect():
     room = session.get("room")
     name = session.get("name")
     leave_room(room)
 
-    if room in rooms:
-        rooms[room]["members"] -= 1
-        if rooms[room]["members"] <= 0:
-            del rooms[room]
+    if session.pop("joined_room", None) == room:
+        members = room_registry.leave(room)
+        if members is not None:
+            metrics.room_size(room, members)
+        if members == 0:
+            chat_history.close_room(room)
+            context_builder.close_room(room)
 
-    send({"name": name, "message": "has left the room"}, to=room)
-    print(f"{name} has left the room {room}")
+    broadcaster.publish(room, {"name": name, "message": "has left the room"})
+    app.logger.debug("%s has left the room %s", name, room)
 
 
 @socketio.on("message")
+@metrics.socket_event
 def message(data):
     room = session.get("room")
-    if room not in rooms:
+    if not room_registry.exists(room):
         return
 
-    content = {
-        "name": session.get("name"),
-        "message": data["data"]
-    }
-    send(content, to=room)
-    rooms[room]["messages"].append(content)
-    print(f"{session.get('name')} said: {data['data']}")
+    content = chat_history.append(room, session.get("name"), data["data"])
+    context_builder.add_turn(room, content["name"], content["message"])
+    broadcaster.publish(room, content)
+    app.logger.debug("%s said: %s", session.get('name'), data['data'])
 
 
-# Press the green button in the gutter to run the script.
+@socketio.on("history")
+@metrics.socket_event
+def history(data):
+    room = session.get("room")
+    if not room_registry.exists(room):
+        return {"messages": [], "has_more": False}
+
+    before = data.get("before")
+    limit = min(int(data.get("limit") or app.config['CHAT_PAGE_SIZE']), app.config['CHAT_PAGE_SIZE'])
+    messages, has_more = chat_history.before(room, int(before) if before is not None else None, limit)
+    return {"messages": messages, "has_more": has_more}
+
+
+@socketio.on("ask")
+@metrics.socket_event
+def ask(data):
+    room = session.get("room")
+    question = (data.get("question") or "").strip()
+    if not room_registry.exists(room) or not question:
+        return {"error": "Ask your question from a chat room."}
+    if not app.config['INFERENCE_MODEL']:
+        return {"error": "The assistant is not available."}
+
+    name = session.get("name")
+    # An answer depends on the conversation before the question, so cached answers, which are keyed
+    # by the question alone, are only used for a room's first question.
+    cached = None if context_builder.has_history(room) else answer_cache.lookup(question)
+    if cached is not None and cached.answer is not None:
+        context_builder.add_turn(room, name, question)
+        context_builder.add_turn(room, ASSISTANT, cached.answer)
+        return {"answer": cached.answer}
+
+    if retriever is not None:
+        passages = [(document['_id'], document['text'])
+                    for document in retriever.retrieve([question], app.config['CONTEXT_PASSAGES'])[0]]
+    else:
+        _, hits = document_search.search(question, app.config['CONTEXT_PASSAGES'])
+        found = {document['_id']: document['text'] for document in
+                 mongo_collection.find({'_id': {'$in': [key for key, _ in hits]}}, {'text': 1})}
+        passages = [(key, found[key]) for key, _ in hits if key in found]
+    context = context_builder.build(room, question, passages)
+    context_builder.add_turn(room, name, question)
+
+    sid = request.sid
+    pieces = []
+
+    def on_token(generation, piece):
+        pieces.append(piece)
+        socketio.emit("answer_token", {"id": generation.id, "token": piece}, to=sid)
+
+    def on_done(generation, error):
+        if error is None:
+            if cached is not None:
+                answer_cache.store(cached, "".join(pieces))
+            context_builder.add_turn(room, ASSISTANT, "".join(pieces))
+        socketio.emit("answer_done", {"id": generation.id, "error": "The assistant failed to answer." if error else None},
+                      to=sid)
+
+    try:
+        generation = inference_engine.submit(context.prompt, on_token, on_done)
+    except QueueFull as e:
+        return {"error": str(e)}
+    return {"id": generation.id}
+
+
+# Development server; see serve.py for production.
 if __name__ == '__main__':
     socketio.run(app, debug=True, allow_unsafe_werkzeug=True)
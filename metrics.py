@@ -0,0 +1,340 @@
+"""
+Request, SQL and Socket.IO metrics, served at /metrics in the Prometheus text format.
+
+Every HTTP request is timed per endpoint, together with the number of SQL statements it ran and
+the time they took (from SQLAlchemy cursor events). Socket.IO handlers decorated with
+socket_event() are counted and timed per event, and the chat rooms report their member counts.
+The stats() of the other components (connection pool, caches, queues) are registered as
+collectors and exported as gauges.
+
+Requests slower than the slow-request threshold keep a profile: once a request has run past the
+threshold, a background thread samples its stack every few milliseconds, and the samples are kept
+at /metrics/slow as collapsed stacks (the format flame graph tools read). Requests that finish in
+time are never sampled. Sampling sees OS threads, so under a green-thread server only the requests
+of the hub thread are profiled.
+
+Both endpoints answer only requests carrying METRICS_TOKEN; without a token configured they are off.
+"""
+import bisect
+import hmac
+import inspect
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from functools import wraps
+
+from flask import Response, abort, g, has_request_context, jsonify, request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labels, le=bound)} {cumulative}'
+        yield f'{name}_bucket{_labels(labels, le="+Inf")} {self.count}'
+        yield f'{name}_sum{_labels(labels)} {self.sum}'
+        yield f'{name}_count{_labels(labels)} {self.count}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    return None
+
+
+class SlowRequestSampler:
+    """
+    Samples the stacks of the running requests that have taken longer than `threshold` and keeps their samples.
+    """
+
+    def __init__(self, threshold=1.0, interval=0.005, keep=50, depth=40):
+        self.threshold = threshold
+        self.interval = interval
+        self.depth = depth
+        self.profiles = deque(maxlen=keep)
+        self.slow_requests = 0
+
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def _ensure_thread(self):
+        # The sampling thread does not survive fork(); a forked web worker starts its own.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._run, name='slow-request-sampler', daemon=True).start()
+                    self._pid = os.getpid()
+
+    def start(self):
+        self._ensure_thread()
+        with self._lock:
+            self._active[threading.get_ident()] = (time.perf_counter(), Counter())
+        self._wake.set()
+
+    def finish(self, duration, **details):
+        with self._lock:
+            _, stacks = self._active.pop(threading.get_ident(), (None, None))
+            if not self._active:
+                self._wake.clear()
+            if stacks is None or duration < self.threshold:
+                return
+            self.slow_requests += 1
+            self.profiles.append(dict(details, duration_ms=round(duration * 1000, 1), samples=sum(stacks.values()),
+                                      stacks=[{'stack': stack, 'samples': count}
+                                              for stack, count in stacks.most_common(30)]))
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.depth:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            now = time.perf_counter()
+            with self._lock:
+                due = [ident for ident, (started, _) in self._active.items() if now - started >= self.threshold]
+                waits = [started + self.threshold - now for started, _ in self._active.values()
+                         if now - started < self.threshold]
+            if not due:
+                # Nothing is slow yet: sleep until the oldest running request could be.
+                time.sleep(min(waits, default=self.interval))
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident in due:
+                    active, frame = self._active.get(ident), frames.get(ident)
+                    if active is not None and frame is not None:
+                        active[1][self._collapse(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+class Metrics:
+    def __init__(self, prefix='flask_ai_lawyer', slow_request_threshold=1.0, sample_interval=0.005, token=None):
+        """
+        :param slow_request_threshold: Seconds after which a request's profile is kept; 0 turns profiling off.
+        :param token: /metrics and /metrics/slow require 'Authorization: Bearer <token>'; None turns them off.
+        """
+        self.prefix = prefix
+        self.token = token
+        self.sampler = SlowRequestSampler(slow_request_threshold, sample_interval) \
+            if slow_request_threshold else None
+
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._latency = {}
+        self._statements = {}
+        self._sql_time = Counter()
+        self._events = Counter()
+        self._event_errors = Counter()
+        self._event_latency = {}
+        self._rooms = {}
+        self._collectors = {}
+
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+
+    @classmethod
+    def from_app(cls, app):
+        config = app.config
+        return cls(slow_request_threshold=config.get('SLOW_REQUEST_MS', 1000) / 1000,
+                   sample_interval=config.get('SLOW_REQUEST_SAMPLE_MS', 5) / 1000,
+                   token=config.get('METRICS_TOKEN'))
+
+    def init_app(self, app, engine):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+        app.add_url_rule('/metrics/slow', 'slow_requests', self._slow_requests_view)
+
+    def register(self, name, collector):
+        """Exports the numbers in the dict returned by collector() as '<prefix>_<name>_<key>' gauges."""
+        self._collectors[name] = collector
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+        if self.sampler:
+            self.sampler.start()
+
+    def _after_request(self, response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        duration = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        with self._lock:
+            self._requests[endpoint, request.method, response.status_code] += 1
+            self._latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(duration)
+            self._statements.setdefault(endpoint, Histogram(STATEMENT_BUCKETS)).observe(g.sql_statements)
+            self._sql_time[endpoint] += g.sql_seconds
+        if self.sampler:
+            self.sampler.finish(duration, endpoint=endpoint, method=request.method, route=request.url_rule.rule if request.url_rule else None,
+                                status=response.status_code, sql_statements=g.sql_statements,
+                                sql_ms=round(g.sql_seconds * 1000, 1))
+        return response
+
+    def _teardown_request(self, exception=None):
+        # Requests that ended without a response (after_request did not run) stop being sampled here.
+        if g.pop('metrics_started', None) is not None and self.sampler:
+            self.sampler.finish(0.0)
+
+    def _before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info['metrics_started'].pop()
+        with self._lock:
+            self.sql_statements += 1
+            self.sql_seconds += elapsed
+        if has_request_context() and 'sql_statements' in g:
+            g.sql_statements += 1
+            g.sql_seconds += elapsed
+
+    def _handle_error(self, context):
+        if context.connection is not None and context.connection.info.get('metrics_started'):
+            context.connection.info['metrics_started'].pop()
+
+    def socket_event(self, handler):
+        """
+        Counts and times a Socket.IO handler under its function name. Goes under @socketio.on(), and passes
+        on only as many arguments as the handler takes (Flask-SocketIO adds the reason to disconnect).
+        """
+        name = handler.__name__
+        parameters = inspect.signature(handler).parameters.values()
+        accepted = None if any(p.kind == p.VAR_POSITIONAL for p in parameters) else len(parameters)
+
+        @wraps(handler)
+        def wrapper(*args):
+            started = time.perf_counter()
+            try:
+                return handler(*args[:accepted])
+            except Exception:
+                with self._lock:
+                    self._event_errors[name] += 1
+                raise
+            finally:
+                with self._lock:
+                    self._events[name] += 1
+                    self._event_latency.setdefault(name, Histogram(LATENCY_BUCKETS)) \
+                        .observe(time.perf_counter() - started)
+
+        return wrapper
+
+    def room_size(self, room, members):
+        """Called with a room's member count after each join and leave; rooms at zero are dropped."""
+        with self._lock:
+            if members:
+                self._rooms[room] = members
+            else:
+                self._rooms.pop(room, None)
+
+    def _collector_lines(self):
+        for name, collector in sorted(self._collectors.items()):
+            try:
+                values = collector()
+            except Exception:
+                continue
+            for key, value in sorted(values.items()):
+                metric = f'{self.prefix}_{name}_{key}'
+                if isinstance(value, dict):
+                    samples = [(f'{metric}{_labels({"key": label})}', _number(item)) for label, item in value.items()]
+                else:
+                    samples = [(metric, _number(value))]
+                samples = [(series, number) for series, number in samples if number is not None]
+                if samples:
+                    yield f'# TYPE {metric} gauge'
+                    yield from (f'{series} {number}' for series, number in samples)
+
+    def render(self):
+        p = self.prefix
+        with self._lock:
+            lines = [f'# TYPE {p}_http_requests_total counter']
+            lines += [f'{p}_http_requests_total{_labels(dict(endpoint=e, method=m, status=s))} {n}'
+                      for (e, m, s), n in sorted(self._requests.items())]
+            lines.append(f'# TYPE {p}_http_request_duration_seconds histogram')
+            for endpoint, histogram in sorted(self._latency.items()):
+                lines += histogram.lines(f'{p}_http_request_duration_seconds', {'endpoint': endpoint})
+            lines.append(f'# TYPE {p}_http_request_sql_statements histogram')
+            for endpoint, histogram in sorted(self._statements.items()):
+                lines += histogram.lines(f'{p}_http_request_sql_statements', {'endpoint': endpoint})
+            lines.append(f'# TYPE {p}_http_request_sql_seconds_total counter')
+            lines += [f'{p}_http_request_sql_seconds_total{_labels(dict(endpoint=e))} {s}'
+                      for e, s in sorted(self._sql_time.items())]
+            lines.append(f'# TYPE {p}_sql_statements_total counter')
+            lines.append(f'{p}_sql_statements_total {self.sql_statements}')
+            lines.append(f'# TYPE {p}_sql_seconds_total counter')
+            lines.append(f'{p}_sql_seconds_total {self.sql_seconds}')
+
+            lines.append(f'# TYPE {p}_socketio_events_total counter')
+            lines += [f'{p}_socketio_events_total{_labels(dict(event=e))} {n}' for e, n in sorted(self._events.items())]
+            lines.append(f'# TYPE {p}_socketio_event_errors_total counter')
+            lines += [f'{p}_socketio_event_errors_total{_labels(dict(event=e))} {n}'
+                      for e, n in sorted(self._event_errors.items())]
+            lines.append(f'# TYPE {p}_socketio_event_duration_seconds histogram')
+            for name, histogram in sorted(self._event_latency.items()):
+                lines += histogram.lines(f'{p}_socketio_event_duration_seconds', {'event': name})
+            lines.append(f'# TYPE {p}_socketio_room_members gauge')
+            lines += [f'{p}_socketio_room_members{_labels(dict(room=r))} {n}' for r, n in sorted(self._rooms.items())]
+
+        if self.sampler:
+            lines.append(f'# TYPE {p}_slow_requests_total counter')
+            lines.append(f'{p}_slow_requests_total {self.sampler.slow_requests}')
+        lines += self._collector_lines()
+        return '\n'.join(lines) + '\n'
+
+    def _authorize(self):
+        if not self.token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {self.token}'):
+            abort(401)
+
+    def _metrics_view(self):
+        self._authorize()
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def _slow_requests_view(self):
+        self._authorize()
+        return jsonify(list(self.sampler.profiles) if self.sampler else [])
@@ -0,0 +1,219 @@
+"""
+Response and fragment cache for the post pages.
+
+Whole responses are cached per route, query string and user (the navbar and the owner's buttons
+differ between users); the rendered post lists are cached as fragments shared by all users, so a
+logged-in user's first visit only renders the layout around them. Every key includes the cache
+generation, and new_post, update_post and delete_post start a new generation instead of finding
+and deleting the affected keys.
+
+Responses carry a strong ETag and Last-Modified, so a conditional GET is answered with 304 straight
+from the cache, without running the view.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import g, request, session, make_response
+from flask_login import current_user
+
+
+GENERATION_KEY = 'page-cache:generation'
+
+
+class MemoryCacheBackend:
+    """LRU dictionary of this process."""
+
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """Entries in a SQLite file shared by every worker process on the host; values are JSON."""
+
+    def __init__(self, path, max_entries=20000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                               '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connect().execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        connection = self._connect()
+        connection.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                           (key, json.dumps(value), time.time() + ttl if ttl else None))
+        # Expired and surplus rows are trimmed now and then rather than on every write.
+        if hash(key) % 100 == 0:
+            connection.execute('DELETE FROM cache WHERE expires_at < ?', (time.time(),))
+            connection.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache WHERE expires_at IS NOT NULL '
+                               'ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+
+class RedisCacheBackend:
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+
+def backend_from_url(url):
+    """PAGE_CACHE_BACKEND: 'memory://' (the default), 'sqlite:///path/to/cache.db' or 'redis://...'."""
+    if not url or url == 'memory://':
+        return MemoryCacheBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteCacheBackend(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCacheBackend(url)
+    raise ValueError(f'Unsupported page cache backend: {url}')
+
+
+def _http_date(value):
+    return datetime.fromtimestamp(value, timezone.utc)
+
+
+class PageCache:
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+
+    def generation(self):
+        """Time of the last invalidation; it is part of every key and the lower bound of Last-Modified."""
+        return self.backend.get(GENERATION_KEY) or 0.0
+
+    def invalidate(self):
+        self.backend.set(GENERATION_KEY, max(time.time(), self.generation() + 1e-6))
+
+    def mark_modified(self, *dates):
+        """Called by a cached view with the Post.date_posted values the page shows."""
+        timestamps = [date.replace(tzinfo=timezone.utc).timestamp() for date in dates if date is not None]
+        if timestamps:
+            g.page_last_modified = max(timestamps + [g.get('page_last_modified', 0.0)])
+
+    def fragment(self, name, parts, render):
+        """
+        Returns the cached result of render(), shared by every user. render() returns a dict that
+        must be JSON serializable; a 'last_modified' timestamp in it is applied to the page.
+        """
+        key = f'fragment:{self.generation()}:{name}:{json.dumps(parts)}'
+        value = self.backend.get(key)
+        if value is None:
+            self.fragment_misses += 1
+            value = render()
+            self.backend.set(key, value, self.ttl)
+        else:
+            self.fragment_hits += 1
+        if value.get('last_modified'):
+            g.page_last_modified = max(value['last_modified'], g.get('page_last_modified', 0.0))
+        return value
+
+    def _page_key(self, generation):
+        user = current_user.get_id() if current_user.is_authenticated else 'anonymous'
+        arguments = sorted(request.args.items(multi=True))
+        return f'page:{generation}:{request.endpoint}:{json.dumps(request.view_args, sort_keys=True)}:' \
+               f'{json.dumps(arguments)}:{user}'
+
+    def _respond(self, entry):
+        response = make_response(entry['body'])
+        response.set_etag(entry['etag'])
+        if entry['last_modified']:
+            response.last_modified = _http_date(entry['last_modified'])
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def cached(self, view):
+        """Caches the GET responses of `view`; pages showing flashed messages are never cached."""
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            generation = self.generation()
+            key = self._page_key(generation)
+            entry = self.backend.get(key)
+            if entry is None:
+                self.misses += 1
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.direct_passthrough:
+                    return response
+                body = response.get_data(as_text=True)
+                entry = {
+                    'body': body,
+                    'etag': hashlib.sha1(f'{generation}:{body}'.encode('utf-8')).hexdigest(),
+                    'last_modified': max(g.get('page_last_modified', 0.0), generation),
+                }
+                self.backend.set(key, entry, self.ttl)
+            else:
+                self.hits += 1
+            response = self._respond(entry)
+            if response.status_code == 304:
+                self.not_modified += 1
+            return response
+
+        return wrapper
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'fragment_hits': self.fragment_hits,
+            'fragment_misses': self.fragment_misses,
+        }
@@ -0,0 +1,142 @@
+"""
+Password hashing off the request threads.
+
+bcrypt is deliberately slow, and running it in a web worker blocks that worker (and, under an async
+server, every socket it serves) for the whole hash. PasswordHasher runs hashes and checks in a
+process pool and admits at most `max_pending` of them at a time: past that, hash() and check()
+raise HasherBusy right away, and the app answers 503 instead of queueing without limit.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds, prefix=b'2b')).decode('utf-8')
+
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        return False
+
+
+def hash_rounds(hashed):
+    """The cost factor stored in a '$2b$12$...' hash, or None if it is not a bcrypt hash."""
+    parts = hashed.split('$')
+    return int(parts[2]) if len(parts) > 3 and parts[2].isdigit() else None
+
+
+class PasswordHasher:
+    def __init__(self, rounds=12, workers=None, max_pending=None, timeout=10.0):
+        """
+        :param rounds: bcrypt cost factor for new hashes; logins rehash passwords stored with another one.
+        :param workers: Hashing processes (default: CPU count).
+        :param max_pending: Hashes queued or running at once; the rest are rejected with HasherBusy.
+        """
+        self.rounds = rounds
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.timeout = timeout
+
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._latencies = deque(maxlen=2000)
+
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    @classmethod
+    def from_app(cls, app):
+        config = app.config
+        return cls(rounds=int(config.get('BCRYPT_LOG_ROUNDS', 12)),
+                   workers=int(config.get('PASSWORD_HASH_WORKERS') or 0) or None,
+                   max_pending=int(config.get('PASSWORD_HASH_QUEUE') or 0) or None)
+
+    def _executor(self):
+        # A process pool does not survive fork(); a forked web worker starts its own.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy('Too many logins at once, please try again in a moment.')
+        started = time.perf_counter()
+        try:
+            future = self._executor().submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is freed when the hash finishes, even if this request stopped waiting for it.
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HasherBusy('Password hashing timed out, please try again in a moment.')
+        finally:
+            with self._lock:
+                self.completed += 1
+                self._latencies.append(time.perf_counter() - started)
+
+    def hash(self, password):
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def check_and_rehash(self, user, password):
+        """
+        Checks `password` against user.password. On success, a hash made with another cost factor is
+        replaced (the caller commits); a rehash that cannot be admitted right now waits for the next login.
+        """
+        if not self.check(user.password, password):
+            return False
+        if self.needs_rehash(user.password):
+            try:
+                user.password = self.hash(password)
+            except HasherBusy:
+                return True
+            with self._lock:
+                self.rehashed += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+            def percentile(p):
+                return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 1) \
+                    if latencies else None
+
+            return {
+                'rounds': self.rounds,
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'rehashed': self.rehashed,
+                'latency_p50_ms': percentile(0.5),
+                'latency_p95_ms': percentile(0.95),
+                'latency_p99_ms': percentile(0.99),
+            }
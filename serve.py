@@ -0,0 +1,99 @@
+"""
+Production server: HTTP and Socket.IO from one gevent (or eventlet) process.
+
+Every connection is a green thread instead of an OS thread, so idle chat sockets cost a few
+kilobytes each and never hold up HTTP requests. The standard library is monkey-patched before the
+app is imported, which makes pymongo, SMTP (the mail queue workers) and the app's background
+threads cooperative; psycopg2 is made cooperative by psycogreen when it is installed. bcrypt and
+avatar resizing already run in process pools, and model forward passes and embeddings run in
+native threads (cooperative.offload). Models are loaded on the event loop, so set PRELOAD_MODELS
+to load them before the first connection instead of during the first question.
+
+    python serve.py --host 0.0.0.0 --port 8000
+    python serve.py --worker eventlet
+
+For more processes, run one per port behind a load balancer with sticky sessions and share
+SOCKETIO_MESSAGE_QUEUE and CHAT_ROOM_REGISTRY between them. `python main.py` stays the development
+server.
+
+Needs the gevent (or eventlet) extra: `poetry install -E gevent`; nothing else in the app imports them.
+"""
+import argparse
+import os
+import socket
+import sys
+
+WORKERS = ('gevent', 'eventlet')
+
+
+def patch(worker):
+    """Monkey-patches the standard library for `worker`; must run before the app or pymongo is imported."""
+    if worker == 'gevent':
+        from gevent import monkey
+
+        monkey.patch_all()
+    else:
+        import eventlet
+
+        eventlet.monkey_patch()
+
+    os.environ['SOCKETIO_ASYNC_MODE'] = worker
+    try:
+        if worker == 'gevent':
+            from psycogreen.gevent import patch_psycopg
+        else:
+            from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        if os.getenv('SQLALCHEMY_DATABASE_URL', '').startswith('postgres'):
+            print('psycogreen is not installed: every Postgres query blocks the whole process', file=sys.stderr)
+
+
+def _gevent_server(app, host, port):
+    """The pywsgi server socketio.run() would start, with TCP_NODELAY on every accepted connection."""
+    from gevent import pywsgi
+
+    try:
+        from geventwebsocket.handler import WebSocketHandler as handler_class
+    except ImportError:
+        # Websockets then come from simple-websocket, as in socketio.run().
+        handler_class = pywsgi.WSGIHandler
+
+    class NoDelayServer(pywsgi.WSGIServer):
+        """
+        pywsgi writes the headers and the body of a response separately; with Nagle's algorithm on, the
+        body then waits for the client's delayed ACK (about 40 ms) on every keep-alive request.
+        """
+
+        def handle(self, client, address):
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            super().handle(client, address)
+
+    return NoDelayServer((host, port), app, handler_class=handler_class)
+
+
+def run(host, port):
+    from main import app, socketio
+
+    if app.config['SOCKETIO_ASYNC_MODE'] != 'gevent':
+        socketio.run(app, host=host, port=port)
+        return
+    # Built here rather than by socketio.run(), which has no way to pass a server class; kept on
+    # socketio so that socketio.stop() still works.
+    socketio.wsgi_server = _gevent_server(app, host, port)
+    socketio.wsgi_server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the app under a cooperative server.')
+    parser.add_argument('--worker', choices=WORKERS, default='gevent')
+    parser.add_argument('--host', default=os.getenv('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', 8000)))
+    args = parser.parse_args(argv)
+
+    patch(args.worker)
+    run(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
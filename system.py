@@ -1,5 +1,4 @@
-from PIL import Image
-from flask import Flask, render_template
+from flask import Flask, render_template, url_for
 from flask_login import LoginManager
 from flask_jwt_extended import JWTManager
 from flask_bcrypt import Bcrypt
@@ -7,9 +6,11 @@ from flask_mail import Message
 from flask_mail import Mail
 from flask_socketio import SocketIO
 
+from mail_queue import MailQueue
+from passwords import PasswordHasher
+from avatars import AvatarPipeline, avatar_filename, is_digest
 
 import os
-import secrets
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
@@ -25,26 +26,71 @@ app.config['MAIL_PORT'] = os.getenv('MAIL_PORT')
 app.config['MAIL_USE_SSL'] = True
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
-
+app.config['MAIL_TRANSPORT'] = os.getenv('MAIL_TRANSPORT', 'smtp')
+app.config['MAIL_FILE_DIR'] = os.getenv('MAIL_FILE_DIR')
+app.config['MAIL_QUEUE_WORKERS'] = int(os.getenv('MAIL_QUEUE_WORKERS', 1))
+app.config['MAIL_BATCH_SIZE'] = int(os.getenv('MAIL_BATCH_SIZE', 20))
+
+app.config['CHAT_HISTORY_SIZE'] = int(os.getenv('CHAT_HISTORY_SIZE', 200))
+app.config['CHAT_PAGE_SIZE'] = int(os.getenv('CHAT_PAGE_SIZE', 50))
+# Anything but memory:// means several workers: chat history is then written to and read from Mongo.
+app.config['CHAT_ROOM_REGISTRY'] = os.getenv('CHAT_ROOM_REGISTRY', 'memory://')
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+# Chat messages to a room are sent together once per window; 0 sends every message on its own.
+app.config['CHAT_BROADCAST_WINDOW_MS'] = int(os.getenv('CHAT_BROADCAST_WINDOW_MS', 20))
+app.config['CHAT_BROADCAST_MAX_BATCH'] = int(os.getenv('CHAT_BROADCAST_MAX_BATCH', 100))
+app.config['CHAT_BROADCAST_ENCODING'] = os.getenv('CHAT_BROADCAST_ENCODING', 'json')
+# 'threading' for the development server; serve.py sets 'gevent' or 'eventlet' after monkey-patching.
+app.config['SOCKETIO_ASYNC_MODE'] = os.getenv('SOCKETIO_ASYNC_MODE', 'threading')
+app.config['INFERENCE_MODEL'] = os.getenv('INFERENCE_MODEL')
+app.config['INFERENCE_MAX_BATCH'] = int(os.getenv('INFERENCE_MAX_BATCH', 8))
+app.config['INFERENCE_MAX_WAIT_MS'] = int(os.getenv('INFERENCE_MAX_WAIT_MS', 20))
+# Prompt tokens for the assistant: instructions, question, summary of older turns, passages and recent turns.
+app.config['CONTEXT_TOKEN_BUDGET'] = int(os.getenv('CONTEXT_TOKEN_BUDGET', 768))
+app.config['CONTEXT_SUMMARY_TOKENS'] = int(os.getenv('CONTEXT_SUMMARY_TOKENS', 128))
+app.config['CONTEXT_PASSAGES'] = int(os.getenv('CONTEXT_PASSAGES', 5))
+# Directory of an ai.vector_index index; when set, the assistant's passages come from it instead of BM25.
+app.config['VECTOR_INDEX_DIR'] = os.getenv('VECTOR_INDEX_DIR')
+app.config['VECTOR_INDEX_NPROBE'] = int(os.getenv('VECTOR_INDEX_NPROBE', 16))
+app.config['EMBEDDING_MODEL'] = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+# Comma-separated model names (generator, embedder, tokenizer, sentence_splitter) to load before workers fork.
+app.config['PRELOAD_MODELS'] = [name.strip() for name in os.getenv('PRELOAD_MODELS', '').split(',') if name.strip()]
+app.config['ANSWER_CACHE_SIZE'] = int(os.getenv('ANSWER_CACHE_SIZE', 1000))
+app.config['ANSWER_CACHE_TTL'] = int(os.getenv('ANSWER_CACHE_TTL', 7 * 24 * 3600))
+# Cosine similarity at which a cached answer is reused for a differently worded question; 0 disables it.
+app.config['ANSWER_CACHE_SIMILARITY'] = float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.92))
+app.config['AVATAR_DIR'] = os.getenv('AVATAR_DIR')
+app.config['AVATAR_WORKERS'] = int(os.getenv('AVATAR_WORKERS', 2))
+app.config['PAGE_CACHE_BACKEND'] = os.getenv('PAGE_CACHE_BACKEND', 'memory://')
+app.config['PAGE_CACHE_TTL'] = int(os.getenv('PAGE_CACHE_TTL', 300))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = os.getenv('PASSWORD_HASH_WORKERS')
+app.config['PASSWORD_HASH_QUEUE'] = os.getenv('PASSWORD_HASH_QUEUE')
+# Requests slower than this keep a sampled stack profile at /metrics/slow; 0 turns the sampler off.
+app.config['SLOW_REQUEST_MS'] = int(os.getenv('SLOW_REQUEST_MS', 1000))
+app.config['SLOW_REQUEST_SAMPLE_MS'] = int(os.getenv('SLOW_REQUEST_SAMPLE_MS', 5))
+# Bearer token for /metrics and /metrics/slow; unset, both endpoints are disabled.
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
 
 mail = Mail(app)
+mail_queue = MailQueue.from_app(app)
+avatar_pipeline = AvatarPipeline.from_app(app)
 
 jwt = JWTManager(app)
 bcrypt = Bcrypt(app)
+password_hasher = PasswordHasher.from_app(app)
 
 
 def save_picture(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(app.root_path, 'static/profile_pics', picture_fn)
+    """Returns the value for User.image_file; resizing runs in the avatar worker pool."""
+    return avatar_pipeline.submit(form_picture)
 
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
 
-    return picture_fn
+@app.template_global()
+def avatar_url(image_file, size='md', extension='jpg'):
+    if not is_digest(image_file):
+        return url_for('static', filename='profile_pics/' + image_file)
+    return url_for('avatar', filename=avatar_filename(image_file, size, extension))
 
 
 def pagination_range(current_page, total_pages, neighbors=2):
@@ -76,8 +122,8 @@ def send_reset_email(user):
         msg.body = render_template('email/reset_password.txt', user=user, token=token)
         msg.html = render_template('email/reset_password.html', user=user, token=token)
 
-        # Send the message within the application context
-        mail.send(msg)
+        # Serialized within the application context, delivered by the mail queue workers
+        mail_queue.enqueue(msg)
 
 
 
@@ -92,5 +138,5 @@ def send_confirm_email(user):
         msg.body = render_template('email/confirm_email.txt', user=user, token=token)
         msg.html = render_template('email/confirm_email.html', user=user, token=token)
 
-        # Send the message within the application context
-        mail.send(msg)
\ No newline at end of file
+        # Serialized within the application context, delivered by the mail queue workers
+        mail_queue.enqueue(msg)
\ No newline at end of file
@@ -0,0 +1,380 @@
+import logging
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+
+import numpy as np
+from sqlalchemy import delete, func, select
+
+from database.sql_db.models import Post, PostChange
+
+logger = logging.getLogger(__name__)
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+STOPWORDS = frozenset('a an and are as at be by for from has he in is it its of on or that the to was were will '
+                      'with this which not but they you your i we'.split())
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS and len(token) > 1]
+
+
+# Largest gap one entry of a postings list can hold; longer gaps are bridged by filler entries.
+MAX_GAP = 65535
+
+
+def encode_postings(numbers, tfs):
+    """
+    Delta-encodes sorted document numbers as array('H') gaps from the previous number (the first
+    from 0), next to their term frequencies. A gap of MAX_GAP or more is split into filler entries
+    of MAX_GAP with a term frequency of 0, followed by the remainder.
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    gaps = np.diff(numbers, prepend=0)
+    fillers = gaps // MAX_GAP
+    if not fillers.any():
+        return array('H', gaps.astype(np.uint16).tobytes()), array('H', np.asarray(tfs, dtype=np.uint16).tobytes())
+    ends = np.cumsum(fillers + 1) - 1
+    encoded_gaps = np.full(ends[-1] + 1, MAX_GAP, dtype=np.uint16)
+    encoded_tfs = np.zeros(ends[-1] + 1, dtype=np.uint16)
+    encoded_gaps[ends] = gaps - fillers * MAX_GAP
+    encoded_tfs[ends] = tfs
+    return array('H', encoded_gaps.tobytes()), array('H', encoded_tfs.tobytes())
+
+
+def decode_postings(gaps, tfs):
+    """:return: (document numbers, term frequencies) of a postings list as numpy arrays, fillers dropped."""
+    tfs = np.frombuffer(tfs, dtype=np.uint16)
+    numbers = np.cumsum(np.frombuffer(gaps, dtype=np.uint16), dtype=np.uint32)
+    real = tfs > 0
+    return numbers[real], tfs[real]
+
+
+class Postings:
+    """A term's postings list, delta-encoded as by encode_postings()."""
+
+    __slots__ = ('gaps', 'tfs', 'last')
+
+    def __init__(self, gaps=None, tfs=None, last=0):
+        self.gaps = gaps if gaps is not None else array('H')
+        self.tfs = tfs if tfs is not None else array('H')
+        # The last document number in the list, which the next gap is counted from.
+        self.last = last
+
+    def append(self, number, tf):
+        gap = number - self.last
+        while gap >= MAX_GAP:
+            self.gaps.append(MAX_GAP)
+            self.tfs.append(0)
+            gap -= MAX_GAP
+        self.gaps.append(gap)
+        self.tfs.append(min(tf, 65535))
+        self.last = number
+
+
+class BM25Index:
+    """
+    In-memory inverted index with BM25 ranking, updated one document at a time.
+
+    Every added document gets a new, increasing internal number, so each postings list stays
+    sorted and is stored delta-encoded: the gaps between consecutive numbers and the term
+    frequencies, two array('H'), which search() decodes and scores with numpy. Removing or
+    replacing a document only marks its number as deleted; once a quarter of the numbers belong
+    to deleted documents, the postings are rewritten and the live documents renumbered.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}
+        self._df = Counter()
+        self._docs = {}
+        self._numbers = {}
+        # Token count of every document number; 0 once the document is deleted.
+        self._lengths = array('I')
+        self._total_length = 0
+        self._deleted = 0
+        # Length normalization of every document number for the current contents, built by the next search.
+        self._norm = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def add(self, key, text):
+        """Indexes `text` under `key`, replacing the previous version of that document unless it is the same."""
+        digest = hash(text)
+        with self._lock:
+            number = self._numbers.get(key)
+            if number is not None and self._docs[number][2] == digest:
+                return
+        terms = Counter(tokenize(text))
+        with self._lock:
+            self._remove(key)
+            number = len(self._lengths)
+            for term, tf in terms.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = Postings()
+                postings.append(number, tf)
+                self._df[term] += 1
+            length = sum(terms.values())
+            self._lengths.append(length)
+            self._docs[number] = (key, tuple(terms), digest)
+            self._numbers[key] = number
+            self._total_length += length
+            self._norm = None
+            self._maybe_compact()
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+            self._maybe_compact()
+
+    def _remove(self, key):
+        number = self._numbers.pop(key, None)
+        if number is None:
+            return
+        _, terms, _ = self._docs.pop(number)
+        for term in terms:
+            self._df[term] -= 1
+        self._total_length -= self._lengths[number]
+        self._lengths[number] = 0
+        self._deleted += 1
+        self._norm = None
+
+    def _maybe_compact(self):
+        if self._deleted * 4 > len(self._lengths):
+            self._compact()
+
+    def _compact(self):
+        alive = np.zeros(len(self._lengths), dtype=bool)
+        alive[list(self._docs)] = True
+        renumber = (np.cumsum(alive) - 1).astype(np.uint32)
+        postings = {}
+        for term, old in self._postings.items():
+            if not self._df[term]:
+                continue
+            numbers, tfs = decode_postings(old.gaps, old.tfs)
+            keep = alive[numbers]
+            numbers = renumber[numbers[keep]]
+            postings[term] = Postings(*encode_postings(numbers, tfs[keep]), last=int(numbers[-1]))
+        lengths = array('I', np.frombuffer(self._lengths, dtype=np.uint32)[alive].tobytes())
+        self._postings = postings
+        self._lengths = lengths
+        self._docs = {int(renumber[number]): doc for number, doc in self._docs.items()}
+        self._numbers = {key: int(renumber[number]) for key, number in self._numbers.items()}
+        self._df = +self._df
+        self._deleted = 0
+        self._norm = None
+
+    def _scores(self, terms):
+        """
+        BM25 score of every document number (float32, plenty to rank by), 0 for the ones matching no
+        term. Call with the lock held: the numpy views of the arrays must be gone before add() appends
+        to them, so only fresh arrays are returned.
+        """
+        count = len(self._docs)
+        k1, b = self.k1, self.b
+        norm = self._norm
+        if norm is None:
+            lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                norm = (k1 * (1 - b + b * lengths / (self._total_length / count))).astype(np.float32)
+            # A deleted document's is infinite, so it scores 0 for every term.
+            norm[lengths == 0] = np.inf
+            self._norm = norm
+        scores = np.zeros(len(norm), dtype=np.float32)
+        for term in terms:
+            postings = self._postings.get(term)
+            df = self._df.get(term, 0)
+            if postings is None or not df:
+                continue
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            numbers, tfs = decode_postings(postings.gaps, postings.tfs)
+            tfs = tfs.astype(np.float32)
+            scores[numbers] += np.float32(idf * (k1 + 1)) * tfs / (tfs + norm[numbers])
+        return scores
+
+    def search(self, query, limit=10, offset=0):
+        """
+        :return: (number of matching documents, [(key, score), ...] for the requested page, best first)
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            if not self._docs or not terms:
+                return 0, []
+            scores = self._scores(terms)
+            hits = np.flatnonzero(scores)
+            total, wanted = len(hits), offset + limit
+            if len(hits) > wanted:
+                hits = hits[np.argpartition(-scores[hits], wanted - 1)[:wanted]]
+            best = hits[np.argsort(-scores[hits], kind='stable')][offset:wanted]
+            return total, [(self._docs[int(number)][0], float(scores[number])) for number in best]
+
+
+class PostSearch(BM25Index):
+    """
+    BM25 over Post.title and Post.content. A background thread loads every post once, then every
+    `refresh_interval` seconds applies what other worker processes wrote meanwhile: posts with an id
+    above the highest one indexed, and the posts named in post_changes (edited or deleted) since the
+    last row read. This process's own writes are applied at once by add_post and remove_post.
+
+    Ids of transactions that commit out of order can land behind the last one read, so each pass
+    looks `overlap` ids back; re-adding an unchanged post is a no-op.
+    """
+
+    def __init__(self, engine, refresh_interval=10.0, overlap=100, keep_changes=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self.overlap = overlap
+        self.keep_changes = keep_changes
+        self.loaded = False
+        self.loads = 0
+        self.load_seconds = 0.0
+        self._last_post = 0
+        self._last_change = 0
+        self._pid = None
+
+    def start(self):
+        # The refresh thread does not survive fork(); a forked web worker starts its own.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='post-search', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                if self.loaded:
+                    self.sync()
+                else:
+                    self._load()
+            except Exception:
+                logger.exception('Updating the post search index failed')
+            time.sleep(self.refresh_interval)
+
+    def _index(self, connection, query):
+        for rows in connection.execution_options(yield_per=1000).execute(query).partitions():
+            for post_id, title, content in rows:
+                self.add(post_id, f'{title}\n{content}')
+                self._last_post = max(self._last_post, post_id)
+            # Lets the requests of a green-thread server run between batches.
+            time.sleep(0)
+
+    def _load(self):
+        started = time.perf_counter()
+        with self.engine.connect() as connection:
+            # Read first: changes made while the posts are loading are applied again by the next sync().
+            self._last_change = connection.execute(select(func.max(PostChange.id))).scalar() or 0
+            self._index(connection, select(Post.id, Post.title, Post.content))
+        self.loaded = True
+        self.loads += 1
+        self.load_seconds = round(time.perf_counter() - started, 3)
+
+    def sync(self):
+        """Applies the posts written, edited or deleted since the last call."""
+        with self.engine.connect() as connection:
+            first_change = connection.execute(select(func.min(PostChange.id))).scalar()
+            if first_change is not None and first_change > self._last_change + 1:
+                # The rows this process has not read yet were pruned; only a full load catches up.
+                self.loaded = False
+                return
+            changes = connection.execute(select(PostChange.id, PostChange.post_id)
+                                         .where(PostChange.id > self._last_change - self.overlap)
+                                         .order_by(PostChange.id)).all()
+            changed = {post_id for _, post_id in changes}
+            self._index(connection, select(Post.id, Post.title, Post.content)
+                        .where(Post.id > self._last_post - self.overlap).order_by(Post.id))
+            if changed:
+                stored, changed_ids = set(), sorted(changed)
+                for chunk in range(0, len(changed_ids), 500):
+                    ids = changed_ids[chunk:chunk + 500]
+                    query = select(Post.id, Post.title, Post.content).where(Post.id.in_(ids))
+                    stored.update(post_id for post_id, _, _ in connection.execute(query))
+                    self._index(connection, query)
+                for post_id in changed - stored:
+                    self.remove(post_id)
+            if changes:
+                self._last_change = max(self._last_change, changes[-1][0])
+                # Rows every worker has long read; any process may prune them.
+                connection.execute(delete(PostChange).where(PostChange.id <= self._last_change - self.keep_changes))
+                connection.commit()
+
+    def add_post(self, post):
+        self.add(post.id, f'{post.title}\n{post.content}')
+
+    def remove_post(self, post_id):
+        self.remove(post_id)
+
+    def search(self, query, limit=10, offset=0):
+        self.start()
+        return super().search(query, limit, offset)
+
+    def stats(self):
+        return {'documents': len(self), 'loaded': self.loaded, 'loads': self.loads,
+                'load_seconds': self.load_seconds, 'last_change': self._last_change}
+
+
+class DocumentSearch(BM25Index):
+    """
+    BM25 over the chunks in documents_collection. A background thread indexes the chunks ingested
+    since its last pass every `sync_interval` seconds, using the same (ingested_at, _id) cursor as
+    the vector index, so no request waits for indexing; until the first pass is through, searches
+    see the chunks indexed so far.
+    """
+
+    def __init__(self, collection, sync_interval=30.0, **kwargs):
+        super().__init__(**kwargs)
+        self.collection = collection
+        self.sync_interval = sync_interval
+        self.cursor = None
+        self.synced = False
+        self._pid = None
+
+    def start(self):
+        # The sync thread does not survive fork(); a forked web worker starts its own.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='document-search', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+                self.synced = True
+            except Exception:
+                logger.exception('Indexing new documents for search failed')
+            time.sleep(self.sync_interval)
+
+    def sync(self, batch_size=200):
+        """Indexes the chunks ingested since the last call; returns how many."""
+        added = 0
+        while True:
+            query = {}
+            if self.cursor:
+                ingested_at, doc_id = self.cursor
+                query = {'$or': [{'ingested_at': {'$gt': ingested_at}},
+                                 {'ingested_at': ingested_at, '_id': {'$gt': doc_id}}]}
+            documents = list(self.collection.find(query, {'text': 1, 'ingested_at': 1})
+                             .sort([('ingested_at', 1), ('_id', 1)]).limit(batch_size))
+            if not documents:
+                return added
+            for document in documents:
+                self.add(document['_id'], document['text'])
+            self.cursor = (documents[-1]['ingested_at'], documents[-1]['_id'])
+            added += len(documents)
+            # Lets the requests of a green-thread server run between batches.
+            time.sleep(0)
+
+    def search(self, query, limit=10, offset=0):
+        self.start()
+        return super().search(query, limit, offset)
+
+    def stats(self):
+        return {'documents': len(self), 'synced': self.synced}